@@ -1,11 +1,22 @@
+import functools
 import os
-from flask import Flask, render_template, request, flash, redirect, session, g
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+from flask import (Flask, render_template, request, flash, redirect, session, g, abort,
+                   url_for, jsonify, make_response)
 from flask_debugtoolbar import DebugToolbarExtension
+from markupsafe import Markup
 from sqlalchemy.exc import IntegrityError
+from caching import (static_url, set_cache_headers, build_token, etag_for, not_modified, with_etag,
+                     LRUCache, Page, PageCache)
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message
+from models import (db, connect_db, upgrade_db, has_full_text_search, known_versions,
+                    User, Message, Follows, Likes, MessageLikeShard, TimelineEntry)
+from search import ReloadingIndex, UsernameIndex, MessageIndex
 
 CURR_USER_KEY = "curr_user"
+CURR_USER_SNAPSHOT_KEY = "curr_user_snapshot"
 
 app = Flask(__name__)
 
@@ -18,30 +29,460 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+app.config['MESSAGES_PER_PAGE'] = 100
+app.config['MATERIALIZED_TIMELINES'] = True
+app.config['LIKE_SHARD_THRESHOLD'] = 1000
+app.config['USERS_PER_PAGE'] = 48
+app.config['SEARCH_MAX_PAGES'] = 20
+app.config['SUGGEST_MAX_RESULTS'] = 20
+app.config['SEARCH_RESULTS_PER_PAGE'] = 20
+app.config['SEARCH_MAX_CANDIDATES'] = 1000
+app.config['SESSION_USER_SNAPSHOT'] = False
+app.config['SESSION_USER_SNAPSHOT_TTL'] = 60
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PAGE_CACHE'] = True
+app.config['PAGE_CACHE_SIZE'] = 1024
+app.config['PAGE_CACHE_TTL'] = 30
+app.config['PAGE_CACHE_PATH'] = os.environ.get('PAGE_CACHE_PATH')
+app.config['FRAGMENT_CACHE_SIZE'] = 10000
+app.config['USERNAME_INDEX_TTL'] = 600
+app.config['MESSAGE_INDEX_TTL'] = 600
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
 
 
+##############################################################################
+# Cursor pagination
+#
+# Message and like lists are paged with a keyset cursor: the id (and, for
+# likes, the time) of the last row shown. Those are indexed in page order,
+# so fetching an older page is an index range read no matter how far back
+# the reader has scrolled.
+
+
+def paginate(query, id_col, per_page=None):
+    """Get a page of rows from `query`, newest first.
+
+    Honors the `before` cursor in the querystring. Returns the rows and the
+    cursor for the next (older) page, or None if this is the last page.
+    Pages are MESSAGES_PER_PAGE long unless `per_page` says otherwise.
+    """
+
+    per_page = per_page or app.config['MESSAGES_PER_PAGE']
+    before = request.args.get('before')
+
+    if before:
+        # isdigit() alone would let through digits int() can't read, like "²"
+        if not (before.isascii() and before.isdigit()):
+            abort(400)
+        query = query.filter(id_col < int(before))
+
+    rows = (query
+            .order_by(id_col.desc())
+            .limit(per_page + 1)
+            .all())
+
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        return rows, rows[-1].id
+
+    return rows, None
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def paginate_by_time(query, time_col, id_col, per_page=None):
+    """Get a page of rows from `query`, latest `time_col` first.
+
+    Like paginate(), for rows whose ids don't follow `time_col`. Ties on
+    time are broken by id, and the `before` cursor names both, as
+    "<microseconds since the epoch>-<id>".
+    """
+
+    per_page = per_page or app.config['MESSAGES_PER_PAGE']
+    before = request.args.get('before')
+
+    if before:
+        micros, _, row_id = before.partition('-')
+        if not all(part.isascii() and part.isdigit() for part in (micros, row_id)):
+            abort(400)
+        at = EPOCH + timedelta(microseconds=int(micros))
+        query = query.filter(db.tuple_(time_col, id_col) < (at, int(row_id)))
+
+    rows = (query
+            .order_by(time_col.desc(), id_col.desc())
+            .limit(per_page + 1)
+            .all())
+
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        micros = (getattr(last, time_col.key) - EPOCH) // timedelta(microseconds=1)
+        return rows, f"{micros}-{last.id}"
+
+    return rows, None
+
+
+##############################################################################
+# Conditional GET
+#
+# Pages that rarely change get a weak ETag made of a few version numbers,
+# read before any real work. A browser revalidating its copy sends the ETag
+# back and, if nothing changed, gets a bodiless 304 without the page's
+# queries or template.
+
+# Part of every page ETag, so a deploy that changes the code, templates or
+# static files (whose fingerprinted URLs pages embed) invalidates them all.
+BUILD = build_token(
+    os.path.join(app.root_path, app.template_folder),
+    app.static_folder,
+    *sorted(os.path.join(app.root_path, name)
+            for name in os.listdir(app.root_path) if name.endswith('.py')))
+
+
+def page_etag(*versions):
+    """ETag for the current page, given `versions` of what it shows.
+
+    Covers the build, the URL and who is looking. None (no ETag) while
+    there are flashed messages to show, as those appear only once.
+    """
+
+    if '_flashes' in session:
+        return None
+
+    viewer = (g.user.id, g.user.version) if g.user else None
+    return etag_for(BUILD, request.full_path, viewer, *versions)
+
+
+##############################################################################
+# Page cache for anonymous visitors
+#
+# Logged out, everyone sees the same page at a given URL, so views wrapped
+# in @cache_for_anonymous keep what they render in page_cache (see
+# PageCache) and serve it again without queries or templates. Views tag the
+# page with what it shows (tag_page); changes to those things invalidate
+# the tags.
+
+page_cache = PageCache(app.config['PAGE_CACHE_SIZE'],
+                       app.config['PAGE_CACHE_TTL'],
+                       app.config['PAGE_CACHE_PATH'])
+
+
+def tag_page(*tags):
+    """Note that the page being rendered shows `tags` (like "user:12")."""
+
+    if 'page_tags' in g:
+        g.page_tags.update(tags)
+
+
+def invalidate_pages(*tags):
+    """Drop cached pages tagged with any of `tags`."""
+
+    page_cache.invalidate(*tags)
+
+
+def cache_for_anonymous(*params):
+    """Serve the view from the page cache to visitors who aren't logged in
+    and have no flashed messages waiting.
+
+    Pages are cached by path and the query parameters `params` the view
+    reads; any others are ignored, so they can't fill the cache with copies.
+    """
+
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if (not app.config['PAGE_CACHE']
+                    or CURR_USER_KEY in session
+                    or '_flashes' in session):
+                return view(*args, **kwargs)
+
+            query = urlencode([(name, request.args[name])
+                               for name in params if name in request.args])
+            key = f"{BUILD} {request.path}?{query}"
+            page = page_cache.get(key)
+
+            if page is None:
+                # Pages rendered from data read before an invalidation of
+                # their tags aren't stored
+                started = time.time()
+                g.page_tags = set()
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+
+                page = Page(response.status_code,
+                            [[name, value] for name, value in response.headers
+                             if name.lower() != 'set-cookie'],
+                            response.get_data())
+                page_cache.set(key, page, g.page_tags, since=started)
+
+            response = app.response_class(page.body, page.status, page.headers)
+            etag, _ = response.get_etag()
+            return not_modified(etag) or response
+
+        return wrapper
+
+    return decorator
+
+
+##############################################################################
+# Message card fragments
+#
+# A warble looks the same in every timeline it appears in, so its card
+# (everything but the per-viewer like button) is rendered once and reused.
+# Messages can't be edited and changing the username or picture bumps the
+# author's profile_version, so a card keyed by (message id, author
+# profile_version) never goes stale; old versions just fall out of the LRU.
+# (The author's version moves with every follow and like, so it would make a
+# poor key.)
+
+fragment_cache = LRUCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+
+def message_card(msg):
+    """The card markup for `msg`, from the fragment cache if possible.
+
+    Expects msg.user to be loaded already.
+    """
+
+    key = (msg.id, msg.user.profile_version)
+    card = fragment_cache.get(key)
+
+    if card is None:
+        card = Markup(app.jinja_env.get_template('messages/card.html')
+                      .render(msg=msg))
+        fragment_cache.set(key, card)
+
+    return card
+
+
+app.jinja_env.globals['message_card'] = message_card
+
+
+##############################################################################
+# Username typeahead
+#
+# Suggestions are served from an index of every username held in this
+# worker's memory, loaded from the database on first use and then kept
+# current by signup, profile edits and account deletion. Those only update
+# the worker that handled them, so every worker also reloads its index once
+# it is USERNAME_INDEX_TTL seconds old, to pick up the others' changes.
+
+username_index = ReloadingIndex(
+    lambda: UsernameIndex(db.session.query(User.id, User.username).yield_per(10000)),
+    app.config['USERNAME_INDEX_TTL'])
+
+
+def get_username_index():
+    """This worker's UsernameIndex, loaded on first use and reloaded once
+    it's USERNAME_INDEX_TTL seconds old."""
+
+    return username_index.get()
+
+
+def reset_username_index():
+    """Forget the index, so the next lookup reloads it from the database."""
+
+    username_index.reset()
+
+
+##############################################################################
+# Message search
+#
+# Postgres 12+ searches messages itself (see Message.search). Elsewhere a
+# MessageIndex in worker memory stands in, loaded by the first search and,
+# once loaded, kept current by posting and deleting messages. Like the
+# username index, it is reloaded once MESSAGE_INDEX_TTL seconds old, to
+# pick up messages posted or deleted through other workers.
+
+message_index = ReloadingIndex(
+    lambda: MessageIndex(db.session.query(Message.id, Message.text).yield_per(10000)),
+    app.config['MESSAGE_INDEX_TTL'])
+
+
+def get_message_index():
+    """This worker's MessageIndex, loaded on first use and reloaded once
+    it's MESSAGE_INDEX_TTL seconds old."""
+
+    return message_index.get()
+
+
+def reset_message_index():
+    """Forget the index, so the next search reloads it from the database."""
+
+    message_index.reset()
+
+
+def search_messages(term, after, limit):
+    """Up to `limit` (message, rank) pairs matching `term`, best first,
+    starting below the (rank, id) cursor `after`."""
+
+    if has_full_text_search(db.engine):
+        return (Message.search(term, after, app.config['SEARCH_MAX_CANDIDATES'])
+                .limit(limit).all())
+
+    ranked = get_message_index().search(term)
+    if after:
+        ranked = [hit for hit in ranked if hit < after]
+    ranked = ranked[:limit]
+
+    messages = (Message.query
+                .filter(Message.id.in_([message_id for _, message_id in ranked]))
+                .options(db.joinedload(Message.user)))
+    by_id = {msg.id: msg for msg in messages}
+
+    # Skip messages deleted by another worker since the index was loaded
+    return [(by_id[message_id], rank) for rank, message_id in ranked
+            if message_id in by_id]
+
+
 ##############################################################################
 # User signup/login/logout
 
 
+# With SESSION_USER_SNAPSHOT on, these fields of the logged in user (all
+# that most pages show of them) ride along in the signed session cookie,
+# so g.user can answer for them without a query.
+SNAPSHOT_FIELDS = ('id', 'username', 'image_url', 'header_image_url',
+                   'messages_count', 'following_count', 'followers_count',
+                   'likes_count', 'version')
+
+# User methods that need nothing but the user's id
+ID_ONLY_METHODS = ('is_following', 'is_followed_by', 'following_ids_among',
+                   'liked_ids_among')
+
+
+def load_user():
+    """The logged in user (or None if they no longer exist), fetched once
+    per request."""
+
+    if '_user' not in g:
+        g._user = User.query.get(session[CURR_USER_KEY])
+        if g._user:
+            save_user_snapshot(g._user)
+
+    return g._user
+
+
+def save_user_snapshot(user):
+    """Store a fresh snapshot of `user` in the session, if snapshots are on.
+
+    It's trusted for SESSION_USER_SNAPSHOT_TTL seconds, until the user
+    changes something themselves, or until this worker sees the user's
+    version move past it (see models.known_versions). Changes made through
+    other workers (someone following them, say) can lag by up to the TTL,
+    but never on requests that write: those always load the user afresh.
+    """
+
+    known_versions.set(user.id, user.version)
+
+    if not app.config['SESSION_USER_SNAPSHOT']:
+        return
+
+    snapshot = {field: getattr(user, field) for field in SNAPSHOT_FIELDS}
+    snapshot['expires'] = time.time() + app.config['SESSION_USER_SNAPSHOT_TTL']
+    session[CURR_USER_SNAPSHOT_KEY] = snapshot
+
+
+class CurrentUser:
+    """Stands in for the logged in User as g.user.
+
+    Loads the user from the database on first use. Given a session
+    snapshot, answers for the snapshot's fields, and for methods that only
+    need the id, without loading anything. Views that change the user
+    should work on `_get_current_object()`.
+    """
+
+    def __init__(self, snapshot=None):
+        object.__setattr__(self, '_snapshot', snapshot)
+
+    def _get_current_object(self):
+        return load_user()
+
+    def __getattr__(self, name):
+        if self._snapshot:
+            if name in SNAPSHOT_FIELDS:
+                return self._snapshot[name]
+            if name in ID_ONLY_METHODS:
+                return getattr(User, name).__get__(self)
+
+        user = self._get_current_object()
+        if user is None:
+            # Deleted since this session's snapshot was taken
+            do_logout()
+            abort(redirect("/login"))
+
+        return getattr(user, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._get_current_object(), name, value)
+
+    def __bool__(self):
+        return bool(self._snapshot) or self._get_current_object() is not None
+
+
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a proxy that loads the user on first use, so requests that
+    never look at it cost no query; with SESSION_USER_SNAPSHOT on, most
+    never need to. Requests that write load the user up front, and log the
+    session out if the user has been deleted. Static files skip this
+    altogether.
+    """
+
+    if request.endpoint == 'static':
+        return
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        user_id = session[CURR_USER_KEY]
+        writing = request.method not in ('GET', 'HEAD')
+
+        # Requests that write always check that the user still exists
+        if (writing or known_versions.get(user_id) == 0) and load_user() is None:
+            do_logout()
+            g.user = None
+            return
+
+        snapshot = None
+        if app.config['SESSION_USER_SNAPSHOT'] and not writing:
+            snapshot = session.get(CURR_USER_SNAPSHOT_KEY)
+            if (not snapshot
+                    or snapshot.get('id') != user_id
+                    or snapshot['expires'] < time.time()
+                    or known_versions.get(user_id) not in (None, snapshot['version'])):
+                snapshot = None
+
+        g.user = CurrentUser(snapshot)
 
     else:
         g.user = None
 
 
+@app.after_request
+def refresh_user_snapshot(response):
+    """After a logged in user's POST, which may have changed their profile
+    or counts, re-take their session snapshot."""
+
+    if (app.config['SESSION_USER_SNAPSHOT']
+            and request.method == 'POST'
+            and CURR_USER_KEY in session):
+        user = load_user()
+        if user:
+            save_user_snapshot(user)
+
+    return response
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    save_user_snapshot(user)
 
 
 def do_logout():
@@ -50,6 +491,8 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(CURR_USER_SNAPSHOT_KEY, None)
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -79,6 +522,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        username_index.update('add', user.id, user.username)
         do_login(user)
 
         return redirect("/")
@@ -98,6 +542,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # Saves the password's rehash, if it needed one
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -120,42 +566,102 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username. Search
+    results come best match first and are paged by 'page' number, up to
+    SEARCH_MAX_PAGES; the full listing is paged with a 'before' cursor.
     """
 
     search = request.args.get('q')
+    per_page = app.config['USERS_PER_PAGE']
 
     if not search:
-        users = User.query.all()
+        users, next_cursor = paginate(User.query, User.id, per_page)
+        next_url = next_cursor and url_for('list_users', before=next_cursor)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = request.args.get('page', 1, type=int)
+        if not 1 <= page <= app.config['SEARCH_MAX_PAGES']:
+            abort(404)
+
+        users = (User.search(search)
+                 .offset((page - 1) * per_page)
+                 .limit(per_page + 1)
+                 .all())
+        next_url = None
+        if len(users) > per_page and page < app.config['SEARCH_MAX_PAGES']:
+            next_url = url_for('list_users', q=search, page=page + 1)
+        users = users[:per_page]
 
-    return render_template('users/index.html', users=users)
+    following_ids = (g.user.following_ids_among(u.id for u in users)
+                     if g.user else set())
+
+    return render_template('users/index.html', users=users,
+                           following_ids=following_ids, next_url=next_url)
+
+
+@app.route('/api/users/suggest')
+def suggest_users():
+    """JSON list of users whose username starts with 'prefix', for
+    typeahead. Takes an optional 'limit', capped at SUGGEST_MAX_RESULTS.
+
+    Answered from the in-memory username index, never the database.
+    """
+
+    prefix = request.args.get('prefix', '')
+    limit = request.args.get('limit', 10, type=int)
+    limit = max(1, min(limit, app.config['SUGGEST_MAX_RESULTS']))
+
+    suggestions = get_username_index().suggest(prefix, limit)
+
+    return jsonify([{'id': user_id, 'username': username}
+                    for user_id, username in suggestions])
 
 
 @app.route('/users/<int:user_id>')
+@cache_for_anonymous('before')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile.
+
+    Answers with a 304 when the browser's copy is still current.
+    """
 
     user = User.query.get_or_404(user_id)
 
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    # The user's version changes with their profile and counts, so with
+    # every message they post or delete.
+    tag_page(f"user:{user.id}")
+
+    etag = page_etag(user.version)
+    response = not_modified(etag)
+    if response:
+        return response
+
+    # Every message here shares `user` as its author; it is already in the
+    # session's identity map, so `message.user` never costs another query.
+    messages, next_cursor = paginate(
+        Message.query.filter(Message.user_id == user_id),
+        Message.id)
+
+    return with_etag(render_template('users/show.html', user=user,
+                                     messages=messages, next_cursor=next_cursor),
+                     etag)
 
 
 @app.route('/users/likes')
 def show_likes():
-    """Show user profile."""
+    """Show messages liked by the currently-logged-in user."""
 
-    likes = g.user.likes
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-  
-    return render_template('users/likes.html', likes=likes)
+    likes, next_cursor = paginate_by_time(
+        Likes.query
+             .filter(Likes.user_id == g.user.id)
+             .options(db.joinedload(Likes.message).joinedload(Message.user)),
+        Likes.timestamp, Likes.id)
+
+    return render_template('users/likes.html', likes=likes,
+                           next_cursor=next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -167,7 +673,10 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    following_ids = g.user.following_ids_among(u.id for u in user.following)
+
+    return render_template('users/following.html', user=user,
+                           following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -179,7 +688,10 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    following_ids = g.user.following_ids_among(u.id for u in user.followers)
+
+    return render_template('users/followers.html', user=user,
+                           following_ids=following_ids)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -190,9 +702,17 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
+    if follow_id == g.user.id:
+        flash("You can't follow yourself.", "danger")
+        return redirect(f"/users/{g.user.id}")
+
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+
+    if not g.user.is_following(followed_user):
+        db.session.add(Follows(user_being_followed_id=followed_user.id,
+                               user_following_id=g.user.id))
+        db.session.commit()
+        invalidate_pages(f"user:{followed_user.id}", f"user:{g.user.id}")
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -206,8 +726,12 @@ def stop_following(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    follow = Follows.query.get((followed_user.id, g.user.id))
+
+    if follow:
+        db.session.delete(follow)
+        db.session.commit()
+        invalidate_pages(f"user:{followed_user.id}", f"user:{g.user.id}")
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -225,14 +749,21 @@ def add_like(message_id):
         flash("You can't like your own warbles.", "danger")
         return redirect("/")
     
-    user_likes = g.user.likes
-    
-    if liked_message in user_likes:
-        g.user.likes = [like for like in user_likes if like != liked_message]
-    else:
-        g.user.likes.append(liked_message)
-        
-    db.session.commit()
+    liked = Likes.toggle(g.user.id, liked_message.id)
+
+    # Spread likes of a popular message over shard rows before they start
+    # queueing up on its row lock
+    if (liked and not liked_message.sharded_likes
+            and liked_message.like_count >= app.config['LIKE_SHARD_THRESHOLD']):
+        MessageLikeShard.enable(liked_message.id)
+
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # A concurrent request (a double click) liked it first
+        db.session.rollback()
+
+    invalidate_pages(f"message:{liked_message.id}", f"user:{g.user.id}")
 
     return redirect("/")
 
@@ -245,18 +776,27 @@ def profile():
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = g.user
+    user = g.user._get_current_object()
     form = UserEditForm(obj=user)
 
     if form.validate_on_submit():
         if User.authenticate(user.username, form.password.data):
+            old_username, old_image_url = user.username, user.image_url
             user.username = form.username.data
             user.email = form.email.data
             user.image_url = form.image_url.data or "/static/images/default-pic.png"
             user.header_image_url = form.header_image_url.data or "/static/images/warbler-hero.jpg"
             user.bio = form.bio.data
+            user.version = User.version + 1
+            if (user.username, user.image_url) != (old_username, old_image_url):
+                user.profile_version = User.profile_version + 1
 
             db.session.commit()
+            invalidate_pages(f"user:{user.id}")
+
+            if user.username != old_username:
+                username_index.update('rename', user.id, old_username, user.username)
+
             return redirect(f"/users/{user.id}")
 
         flash("Wrong password, please try again.", 'danger')
@@ -274,8 +814,27 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user_id, username = g.user.id, g.user.username
+
+    # The delete changes the counts on the pages of everyone the user
+    # followed, was followed by or had likes from, and the like counts of
+    # the messages they liked
+    partners = (db.session.query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id)
+                .union(db.session.query(Follows.user_following_id)
+                       .filter(Follows.user_being_followed_id == user_id))
+                .union(db.session.query(Likes.user_id)
+                       .join(Message, Message.id == Likes.message_id)
+                       .filter(Message.user_id == user_id)))
+    liked = db.session.query(Likes.message_id).filter(Likes.user_id == user_id)
+    tags = ([f"user:{user_id}"]
+            + [f"user:{partner_id}" for (partner_id,) in partners]
+            + [f"message:{message_id}" for (message_id,) in liked])
+
+    db.session.delete(g.user._get_current_object())
     db.session.commit()
+    invalidate_pages(*tags)
+    username_index.update('remove', user_id, username)
 
     return redirect("/signup")
 
@@ -297,21 +856,83 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
-        db.session.commit()
+        for attempt in range(3):
+            msg = Message(text=form.text.data, user_id=g.user.id)
+            db.session.add(msg)
+            try:
+                db.session.commit()
+                break
+            except IntegrityError:
+                # Another process minted the same id (WARBLER_WORKER_ID
+                # unset or shared); try again with a new one
+                db.session.rollback()
+                if attempt == 2:
+                    raise
+
+        invalidate_pages(f"user:{g.user.id}")
+
+        message_index.update('add', msg.id, msg.text)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search messages by 'q', best match first.
+
+    Pages are SEARCH_RESULTS_PER_PAGE long; the 'after' cursor holds the
+    rank and id of the last result shown, as "<rank>_<id>".
+    """
+
+    term = request.args.get('q', '').strip()
+    per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+
+    after = request.args.get('after')
+    if after:
+        try:
+            rank, message_id = after.split('_')
+            after = (float(rank), int(message_id))
+        except ValueError:
+            abort(400)
+
+    results = search_messages(term, after, per_page + 1) if term else []
+
+    next_url = None
+    if len(results) > per_page:
+        results = results[:per_page]
+        last, rank = results[-1]
+        next_url = url_for('messages_search', q=term, after=f"{rank!r}_{last.id}")
+
+    return render_template('messages/search.html', term=term,
+                           messages=[msg for msg, _ in results],
+                           next_url=next_url)
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@cache_for_anonymous()
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message.
+
+    Answers with a 304 when the browser's copy is still current.
+    """
     
-    msg = Message.query.get_or_404(message_id)
-    return render_template('messages/show.html', message=msg)
+    msg = (Message.query
+           .options(db.joinedload(Message.user))
+           .get_or_404(message_id))
+    like_count = Message.like_counts([msg])[msg.id]
+
+    tag_page(f"message:{msg.id}", f"user:{msg.user_id}")
+
+    etag = page_etag(msg.user.version, like_count)
+    response = not_modified(etag, msg.timestamp)
+    if response:
+        return response
+
+    return with_etag(render_template('messages/show.html', message=msg,
+                                     like_count=like_count),
+                     etag, msg.timestamp)
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -327,8 +948,12 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
     
+    text = msg.text
     db.session.delete(msg)
     db.session.commit()
+    invalidate_pages(f"message:{message_id}", f"user:{g.user.id}")
+
+    message_index.update('remove', message_id, text)
 
     return redirect(f"/users/{g.user.id}")
 
@@ -338,44 +963,89 @@ def messages_destroy(message_id):
 
 
 @app.route('/')
+@cache_for_anonymous()
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: most recent messages of followed_users, a page at a time
     """
     
     if g.user:
-        following_ids = [f.id for f in g.user.following] + [g.user.id]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        
-        
-        likes = [msg.id for msg in g.user.likes]
-
-        return render_template('home.html', messages=messages, likes=likes)
+        if app.config['MATERIALIZED_TIMELINES']:
+            messages, next_cursor = paginate(
+                Message.query.join(TimelineEntry)
+                             .filter(TimelineEntry.user_id == g.user.id)
+                             .options(db.joinedload(Message.user)),
+                TimelineEntry.message_id)
+        else:
+            messages, next_cursor = paginate(
+                Message.home_timeline(g.user.id)
+                       .options(db.joinedload(Message.user)),
+                Message.id)
+
+        likes = g.user.liked_ids_among(msg.id for msg in messages)
+        like_counts = Message.like_counts(messages)
+
+        return render_template('home.html', messages=messages, likes=likes,
+                               like_counts=like_counts,
+                               next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# Maintenance commands
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Add missing tables, columns and indexes to an existing database."""
+
+    upgrade_db()
+
+
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    """Rebuild every user's home timeline from messages and follows."""
+
+    TimelineEntry.rebuild()
+    db.session.commit()
+
+
+@app.cli.command('recount-users')
+def recount_users():
+    """Recompute every user's message, follow and like counts."""
+
+    User.recount()
+    db.session.commit()
+
+
+@app.cli.command('recount-likes')
+def recount_likes():
+    """Recompute every message's like count."""
+
+    Message.recount_likes()
+    db.session.commit()
+
+
+@app.cli.command('fold-like-shards')
+def fold_like_shards():
+    """Fold sharded like counts back into their messages."""
+
+    MessageLikeShard.fold()
+    db.session.commit()
+
+
+##############################################################################
+# HTTP caching (see caching.py)
+
+app.jinja_env.globals['static_url'] = static_url
+
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Set caching headers on every response."""
+
+    return set_cache_headers(response)
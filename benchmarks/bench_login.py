@@ -0,0 +1,84 @@
+"""Benchmark login throughput.
+
+Signs up a handful of users in a scratch database, then logs them in over
+and over from several client threads at once and reports logins per
+second, for each bcrypt cost asked for.
+
+Run it like:
+
+    python benchmarks/bench_login.py --rounds 12 10 --threads 8 \
+        --database postgresql:///warbler_bench
+
+Its tables are dropped and recreated, so it refuses to run unless the
+database has "bench" or "scratch" in its name.
+"""
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from scratch import require_scratch_database
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--database', default='postgresql:///warbler_bench')
+parser.add_argument('--rounds', type=int, nargs='+', default=[12, 10])
+parser.add_argument('--threads', type=int, default=os.cpu_count())
+parser.add_argument('--logins', type=int, default=64)
+parser.add_argument('--users', type=int, default=8)
+args = parser.parse_args()
+
+require_scratch_database(args.database)
+
+os.environ['DATABASE_URL'] = args.database
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import app  # noqa: E402  (needs DATABASE_URL set first)
+from models import db, User  # noqa: E402
+
+PASSWORD = "benchmark"
+
+
+def log_in(i):
+    """Log in as one of the benchmark users, through the login view."""
+
+    with app.test_client() as client:
+        res = client.post("/login", data={"username": f"bench{i % args.users}",
+                                          "password": PASSWORD})
+        assert res.status_code == 302, "login failed"
+
+
+def main():
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    db.drop_all()
+    db.create_all()
+
+    for i in range(args.users):
+        User.signup(f"bench{i}", f"bench{i}@example.com", PASSWORD, None)
+    db.session.commit()
+
+    print(f"{args.threads} client threads, "
+          f"{app.config['BCRYPT_THREADS']} hashing threads")
+    print()
+    print(f"{'rounds':>6}  {'logins/s':>10}  {'ms/login':>10}")
+
+    with ThreadPoolExecutor(args.threads) as clients:
+        for rounds in args.rounds:
+            app.config['BCRYPT_LOG_ROUNDS'] = rounds
+
+            # One pass to rehash everyone at this cost, untimed
+            list(clients.map(log_in, range(args.users)))
+
+            start = time.perf_counter()
+            list(clients.map(log_in, range(args.logins)))
+            elapsed = time.perf_counter() - start
+
+            print(f"{rounds:>6}  {args.logins / elapsed:>10.1f}  "
+                  f"{elapsed * 1000 / args.logins:>10.1f}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
@@ -0,0 +1,108 @@
+"""Benchmark username search at scale.
+
+Fills a scratch database with fake users and times the old search
+(unbounded leading-wildcard LIKE) against User.search() with a page limit.
+Only the trigram search path is measured: without pg_trgm the benchmark
+is skipped rather than timing the LIKE fallback.
+
+Run it like:
+
+    python benchmarks/bench_user_search.py --users 1000000 \
+        --database postgresql:///warbler_bench
+
+Its tables are dropped and recreated, so it refuses to run unless the
+database has "bench" or "scratch" in its name.
+"""
+
+import argparse
+import os
+import random
+import statistics
+import string
+import sys
+import time
+from io import StringIO
+
+from scratch import require_scratch_database
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--users', type=int, default=1_000_000)
+parser.add_argument('--database', default='postgresql:///warbler_bench')
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--per-page', type=int, default=48)
+args = parser.parse_args()
+
+require_scratch_database(args.database)
+
+os.environ['DATABASE_URL'] = args.database
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from app import app  # noqa: E402  (needs DATABASE_URL set first)
+from models import db, User, has_trigram_search  # noqa: E402
+
+TERMS = ['ann', 'smith', 'xq', 'bird42', 'zz_top']
+
+
+def fake_username(i):
+    letters = ''.join(random.choices(string.ascii_lowercase, k=random.randint(4, 10)))
+    return f"{letters}{i}"
+
+
+def load_users(count):
+    """Bulk load `count` users, with COPY on Postgres."""
+
+    rows = ((f"user{i}@example.com", fake_username(i), "x") for i in range(count))
+
+    if db.engine.dialect.name == 'postgresql':
+        buffer = StringIO(''.join(f"{e}\t{u}\t{p}\n" for e, u, p in rows))
+        connection = db.engine.raw_connection()
+        with connection.cursor() as cursor:
+            cursor.copy_expert(
+                "COPY users (email, username, password) FROM STDIN", buffer)
+            cursor.execute("ANALYZE users")
+        connection.commit()
+    else:
+        db.session.execute(
+            User.__table__.insert(),
+            [dict(email=e, username=u, password=p) for e, u, p in rows])
+        db.session.commit()
+
+
+def timed(run):
+    """Median wall time of `run` in milliseconds."""
+
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    db.drop_all()
+    db.create_all()
+
+    # Creating the users table installs pg_trgm where the server has it
+    if db.engine.dialect.name != 'postgresql' or not has_trigram_search(db.engine):
+        print("skipped: pg_trgm is unavailable, so User.search() would use "
+              "its LIKE fallback")
+        return
+
+    start = time.perf_counter()
+    load_users(args.users)
+    print(f"loaded {args.users:,} users in {time.perf_counter() - start:.1f}s")
+    print("search path: pg_trgm similarity ranking over the trigram GIN index")
+    print()
+    print(f"{'term':>10}  {'old LIKE (all rows)':>20}  {'User.search (1 page)':>20}")
+
+    for term in TERMS:
+        old = timed(lambda: User.query
+                    .filter(User.username.like(f"%{term}%")).all())
+        new = timed(lambda: User.search(term).limit(args.per_page + 1).all())
+        print(f"{term:>10}  {old:>17.1f} ms  {new:>17.1f} ms")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        main()
@@ -0,0 +1,20 @@
+"""Guard for benchmarks that drop and recreate the tables they run on."""
+
+import sys
+
+from sqlalchemy.engine.url import make_url
+
+SCRATCH_WORDS = ('bench', 'scratch')
+
+
+def require_scratch_database(url):
+    """Exit unless the database `url` names is a scratch one.
+
+    A scratch database has "bench" or "scratch" in its name, like the
+    default warbler_bench; anything else may hold real data.
+    """
+
+    name = make_url(url).database or ''
+    if not any(word in name.lower() for word in SCRATCH_WORDS):
+        sys.exit(f"refusing to drop the tables of database {name!r}: "
+                 f"use one with {' or '.join(map(repr, SCRATCH_WORDS))} in its name")
@@ -0,0 +1,390 @@
+"""HTTP caching for Warbler.
+
+Static files are linked with a fingerprint of their contents in the URL
+(see static_url), so a browser can keep them for a year without asking
+again: when a file changes, so does its URL. Everything else is per-user
+HTML, which browsers may keep but must revalidate on every use; pages with
+an ETag (see etag_for) can answer that with a bodiless 304.
+
+PageCache keeps whole rendered pages server side, for visitors who all see
+the same thing; LRUCache, which it builds on, suits smaller fragments.
+"""
+
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+
+from flask import current_app, make_response, request, url_for
+from werkzeug.security import safe_join
+
+# A year, the longest max-age HTTP caches are expected to honor
+FINGERPRINTED_MAX_AGE = 365 * 24 * 60 * 60
+
+
+@functools.lru_cache(maxsize=None)
+def file_fingerprint(path, mtime):
+    """Short hash of the contents of `path`. Keyed on `mtime` too, so an
+    edited file gets a fresh hash."""
+
+    with open(path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()[:12]
+
+
+def static_fingerprint(filename):
+    """Fingerprint of the static file `filename`, or None if there's no
+    such file."""
+
+    path = safe_join(current_app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except (TypeError, OSError):
+        return None
+    return file_fingerprint(path, mtime)
+
+
+def static_url(filename):
+    """URL for the static file `filename`, fingerprinted with "?v=<hash>".
+
+    Use it in templates instead of hard-coded /static/ paths:
+
+        <link rel="stylesheet" href="{{ static_url('stylesheets/style.css') }}">
+    """
+
+    return url_for('static', filename=filename, v=static_fingerprint(filename))
+
+
+def set_cache_headers(response):
+    """Give `response` the Cache-Control header for what it holds, unless
+    its view already chose one.
+
+    Static files fetched with their current fingerprint are immutable.
+    Other static files, including ones asked for with a stale or made-up
+    fingerprint, get revalidated (Flask sends their ETag and Last-Modified).
+    Pages depend on who's logged in, so only the user's own browser may keep
+    them, and it must check back before reusing them.
+    """
+
+    if request.endpoint == 'static':
+        fingerprinted = (
+            response.status_code in (200, 304)
+            and 'v' in request.args
+            and request.args['v'] == static_fingerprint(request.view_args['filename']))
+
+        if fingerprinted:
+            response.cache_control.public = True
+            response.cache_control.max_age = FINGERPRINTED_MAX_AGE
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+            response.cache_control.max_age = None
+
+    elif 'Cache-Control' not in response.headers:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+
+    return response
+
+
+def build_token(*paths):
+    """Short hash of the names, sizes and modification times of every file
+    under `paths` (files or directories): it changes whenever a deploy
+    changes any of them."""
+
+    digest = hashlib.md5()
+    for path in paths:
+        files = [path] if os.path.isfile(path) else sorted(
+            os.path.join(folder, name)
+            for folder, _, names in os.walk(path) for name in names)
+        for name in files:
+            stat = os.stat(name)
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()[:12]
+
+
+def etag_for(*parts):
+    """Weak ETag value for a response that depends only on `parts`."""
+
+    return hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+
+
+def not_modified(etag, last_modified=None):
+    """A 304 response if the request already holds the `etag` version of
+    this page, else None. A None `etag` never matches.
+
+    Only If-None-Match is checked: a page's ETag covers everything on it,
+    but its Last-Modified date may not.
+    """
+
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+
+    response = current_app.response_class(status=304)
+    return with_etag(response, etag, last_modified)
+
+
+def with_etag(response, etag, last_modified=None):
+    """`response` (or a template's output) with an ETag and Last-Modified."""
+
+    response = make_response(response)
+    if etag is not None:
+        response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+# How long invalidations are remembered, to turn away pages whose rendering
+# began before them; far longer than any page takes to render.
+INVALIDATION_WINDOW = 60
+
+
+class LRUCache:
+    """Values by key, least recently used first out once there are more
+    than `max_entries`, each kept for at most `ttl` seconds (None: for as
+    long as there's room).
+
+    Values can be stored with tags (like "user:12") naming what they were
+    made from, and invalidate() drops every value with a given tag. A value
+    made from data read before an invalidation of one of its tags is turned
+    away (see set's `since`), so a slow render can't store a stale value
+    after the change that invalidated it.
+    """
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._keys_by_tag = defaultdict(set)
+        self._invalidated = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expires(self):
+        return time.time() + self.ttl if self.ttl is not None else None
+
+    def _remember(self, key, value, tags, expires, since=None):
+        with self._lock:
+            if since is not None and any(
+                    self._invalidated.get(tag, 0) >= since for tag in tags):
+                return
+
+            self._forget(key)
+            self._entries[key] = (expires, value, tags)
+            for tag in tags:
+                self._keys_by_tag[tag].add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._forget(next(iter(self._entries)))
+
+    def _forget(self, key):
+        """Drop `key`. Call with the lock held."""
+
+        entry = self._entries.pop(key, None)
+        if entry:
+            for tag in entry[2]:
+                keys = self._keys_by_tag[tag]
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_tag[tag]
+
+    def get(self, key):
+        """The value stored under `key`, or None."""
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires, value, _ = entry
+            if expires is not None and expires <= time.time():
+                self._forget(key)
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, tags=(), since=None):
+        """Store `value` under `key`, tagged with `tags`.
+
+        `since` is when the data `value` was made from was read (a
+        time.time()); if any of `tags` has been invalidated since, `value`
+        is not stored.
+        """
+
+        self._remember(key, value, sorted(set(tags)), self._expires(), since)
+
+    def invalidate(self, *tags):
+        """Drop every value tagged with any of `tags`."""
+
+        now = time.time()
+        with self._lock:
+            for tag in tags:
+                for key in list(self._keys_by_tag.get(tag, ())):
+                    self._forget(key)
+                self._invalidated[tag] = now
+
+            if len(self._invalidated) > self.max_entries:
+                self._invalidated = {
+                    tag: when for tag, when in self._invalidated.items()
+                    if when > now - INVALIDATION_WINDOW}
+
+    def clear(self):
+        """Drop everything."""
+
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_tag.clear()
+            self._invalidated.clear()
+
+
+# A rendered response, as PageCache stores it
+Page = namedtuple('Page', 'status headers body')
+
+
+class PageCache(LRUCache):
+    """A cache of rendered Pages, kept for `ttl` seconds.
+
+    Pages live in this process's memory (an LRUCache) or, given a `path`,
+    only in a SQLite database there, which every worker process on the
+    machine shares: a page rendered by one worker is served by the others,
+    and an invalidation by any worker reaches all of them at once.
+    """
+
+    def __init__(self, max_entries=1024, ttl=30, path=None):
+        super().__init__(max_entries, ttl)
+        self.path = path
+
+        self._local = threading.local()
+        self._sets = 0
+
+        if path:
+            self._connection().executescript("""
+                CREATE TABLE IF NOT EXISTS pages (
+                    key TEXT PRIMARY KEY,
+                    expires REAL NOT NULL,
+                    status INTEGER NOT NULL,
+                    headers TEXT NOT NULL,
+                    body BLOB NOT NULL,
+                    tags TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS page_tags (
+                    tag TEXT NOT NULL,
+                    key TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS tag_invalidations (
+                    tag TEXT PRIMARY KEY,
+                    at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS ix_page_tags_tag ON page_tags (tag);
+                CREATE INDEX IF NOT EXISTS ix_page_tags_key ON page_tags (key);
+                CREATE INDEX IF NOT EXISTS ix_pages_expires ON pages (expires);
+            """)
+
+    # SQLite connections can't be shared between threads, so each thread
+    # opens its own.
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=1,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _delete(self, connection, keys):
+        """Delete `keys` from the SQLite tier, in the caller's transaction."""
+
+        for key in keys:
+            connection.execute("DELETE FROM pages WHERE key = ?", (key,))
+            connection.execute("DELETE FROM page_tags WHERE key = ?", (key,))
+
+    def get(self, key):
+        """The Page stored under `key`, or None."""
+
+        if not self.path:
+            return super().get(key)
+
+        row = self._connection().execute(
+            "SELECT status, headers, body FROM pages "
+            "WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        if row is None:
+            return None
+
+        status, headers, body = row
+        return Page(status, json.loads(headers), body)
+
+    def set(self, key, page, tags=(), since=None):
+        """Store `page` under `key`, tagged with `tags`, unless one of them
+        was invalidated after `since` (see LRUCache.set)."""
+
+        if not self.path:
+            return super().set(key, page, tags, since)
+
+        tags = sorted(set(tags))
+        connection = self._connection()
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+
+            if since is not None and tags and connection.execute(
+                    "SELECT 1 FROM tag_invalidations WHERE at >= ? "
+                    f"AND tag IN ({', '.join('?' * len(tags))})",
+                    [since, *tags]).fetchone():
+                return
+
+            # Sweep out expired pages and old invalidations now and then
+            self._sets += 1
+            if self._sets % 100 == 0:
+                now = time.time()
+                self._delete(connection, [key for (key,) in connection.execute(
+                    "SELECT key FROM pages WHERE expires <= ?", (now,))])
+                connection.execute("DELETE FROM tag_invalidations WHERE at < ?",
+                                   (now - INVALIDATION_WINDOW,))
+
+            connection.execute("DELETE FROM page_tags WHERE key = ?", (key,))
+            connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?)",
+                (key, self._expires(), page.status, json.dumps(page.headers),
+                 page.body, json.dumps(tags)))
+            connection.executemany(
+                "INSERT INTO page_tags VALUES (?, ?)",
+                [(tag, key) for tag in tags])
+
+    def invalidate(self, *tags):
+        """Drop every page tagged with any of `tags`."""
+
+        if not self.path:
+            return super().invalidate(*tags)
+
+        if tags:
+            now = time.time()
+            connection = self._connection()
+            with connection:
+                connection.execute("BEGIN IMMEDIATE")
+                keys = [key for (key,) in connection.execute(
+                    "SELECT DISTINCT key FROM page_tags "
+                    f"WHERE tag IN ({', '.join('?' * len(tags))})", tags)]
+                self._delete(connection, keys)
+                connection.executemany(
+                    "INSERT OR REPLACE INTO tag_invalidations VALUES (?, ?)",
+                    [(tag, now) for tag in tags])
+
+    def clear(self):
+        """Drop every page."""
+
+        super().clear()
+
+        if self.path:
+            self._connection().executescript(
+                "DELETE FROM pages; DELETE FROM page_tags; "
+                "DELETE FROM tag_invalidations;")
@@ -1,13 +1,29 @@
 """SQLAlchemy models for Warbler."""
 
+import functools
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, inspect, literal, select
+from sqlalchemy.schema import AddConstraint, CreateColumn
+
+from caching import LRUCache
+from snowflake import next_id
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# The latest users.version this process has written or read for each user
+# (0 once deleted), so copies of a user held elsewhere, like the session
+# snapshot, can be checked without a query. Only covers changes made by
+# this process.
+known_versions = LRUCache(100000)
+
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
@@ -26,6 +42,20 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    # The primary key leads with user_being_followed_id; this covers
+    # looking up everyone a user follows (home timelines, fan-out).
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', user_following_id),
+    )
+
+    @classmethod
+    def exists(cls, follower_id, followed_id):
+        """Does `follower_id` follow `followed_id`? A primary key lookup."""
+
+        follow = cls.query.filter_by(user_being_followed_id=followed_id,
+                                     user_following_id=follower_id)
+        return db.session.query(follow.exists()).scalar()
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -43,11 +73,46 @@ class Likes(db.Model):
     )
 
     message_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
     )
 
+    # When the like happened; a user's likes are listed and paged by it.
+    # Likes from before the column existed are stamped with the upgrade.
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.text("(now() at time zone 'utc')"),
+    )
+
+    message = db.relationship('Message')
+
+    __table_args__ = (
+        # One like per user per message; also the index toggle() looks up by
+        db.UniqueConstraint(user_id, message_id, name='uq_likes_user_message'),
+        # A user's likes, most recent first
+        db.Index('ix_likes_user_timestamp', user_id, timestamp, id),
+    )
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Like the message if the user hasn't yet, otherwise unlike it.
+
+        Touches only the one row in question. Returns True if the message
+        is now liked.
+        """
+
+        like = cls.query.filter_by(user_id=user_id,
+                                   message_id=message_id).first()
+
+        if like:
+            db.session.delete(like)
+            return False
+
+        db.session.add(cls(user_id=user_id, message_id=message_id))
+        return True
+
 
 class User(db.Model):
     """User in the system."""
@@ -94,25 +159,80 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Denormalized counts, kept current by the ORM events at the bottom of
+    # this module; User.recount() rebuilds them after bulk changes.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
 
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever the profile or the counts above change, so copies of
+    # them cached elsewhere (like the session snapshot) can tell they're
+    # stale.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Bumped only when what a message card shows of its author (username,
+    # picture) changes, so cached cards outlive follows and likes.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    messages = db.relationship('Message', passive_deletes=True)
+
+    # Read only: follow and like by adding or deleting Follows and Likes
+    # rows, whose events keep timelines and counters up to date.
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        viewonly=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        viewonly=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        viewonly=True,
     )
 
     def __repr__(self):
@@ -121,14 +241,90 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=other_user.id, followed_id=self.id)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return Follows.exists(follower_id=self.id, followed_id=other_user.id)
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` is this user following? Returns a set of ids.
+
+        Answers the follow/unfollow question for a whole page of user cards
+        with one query.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id)
+                .filter(Follows.user_being_followed_id.in_(user_ids)))
+        return {followed_id for (followed_id,) in rows}
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` has this user liked? Returns a set of ids.
+
+        Colors the like buttons for a page of messages with one query,
+        however many messages the user has liked overall.
+        """
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        rows = (db.session
+                .query(Likes.message_id)
+                .filter(Likes.user_id == self.id)
+                .filter(Likes.message_id.in_(message_ids)))
+        return {message_id for (message_id,) in rows}
+
+    @classmethod
+    def search(cls, term):
+        """Query for users whose username contains `term`, best match first.
+
+        With pg_trgm installed the match uses the trigram GIN index and
+        results are ranked by trigram similarity. Without it (SQLite dev
+        databases, Postgres servers lacking contrib) it falls back to plain
+        SQL: earlier and tighter matches rank first.
+        """
+
+        escaped = (term.replace('\\', '\\\\')
+                       .replace('%', '\\%')
+                       .replace('_', '\\_'))
+        query = cls.query.filter(cls.username.like(f"%{escaped}%", escape='\\'))
+
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql' and has_trigram_search(db.engine):
+            relevance = (db.func.similarity(cls.username, term).desc(),)
+        else:
+            position = db.func.strpos if dialect == 'postgresql' else db.func.instr
+            relevance = (position(cls.username, term),
+                         db.func.length(cls.username))
+
+        return query.order_by(*relevance, cls.username)
+
+    @classmethod
+    def recount(cls):
+        """Recompute every user's denormalized counts from scratch."""
+
+        def count(model, column):
+            return (select([db.func.count()])
+                    .select_from(model.__table__)
+                    .where(column == cls.id)
+                    .as_scalar())
+
+        db.session.execute(cls.__table__.update().values(
+            messages_count=count(Message, Message.user_id),
+            following_count=count(Follows, Follows.user_following_id),
+            followers_count=count(Follows, Follows.user_being_followed_id),
+            likes_count=count(Likes, Likes.user_id),
+            version=cls.version + 1,
+        ))
+        known_versions.clear()
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -137,7 +333,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -158,13 +354,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made at some other cost than BCRYPT_LOG_ROUNDS is replaced
+        with one at that cost; the caller commits it.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
+                if hash_cost(user.password) != bcrypt_rounds():
+                    user.password = hash_password(password)
                 return user
 
         return False
@@ -175,9 +376,12 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # Snowflake ids: ordering by id is ordering by creation time
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=next_id,
     )
 
     text = db.Column(
@@ -185,10 +389,11 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Called per row, so each message is stamped when it is created
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -197,8 +402,645 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Likes are counted here, except for messages switched to sharded
+    # counting (see MessageLikeShard), whose extra likes land in shard rows.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    sharded_likes = db.Column(
+        db.Boolean,
+        nullable=False,
+        default=False,
+        server_default=db.false(),
+    )
+
     user = db.relationship('User')
 
+    # Serves "this user's messages, newest first" without a sort step
+    __table_args__ = (
+        db.Index('ix_messages_user_id', user_id, id),
+    )
+
+    @classmethod
+    def home_timeline(cls, user_id):
+        """Query for the messages on `user_id`'s home page, read live.
+
+        Joins messages to the follows of `user_id` and unions in their own
+        messages: one statement, with no list of followed ids shipped to
+        the database. TimelineEntry holds the same rows precomputed.
+        """
+
+        followed = (cls.query
+                    .join(Follows,
+                          Follows.user_being_followed_id == cls.user_id)
+                    .filter(Follows.user_following_id == user_id))
+        own = cls.query.filter(cls.user_id == user_id)
+
+        return followed.union_all(own)
+
+    @classmethod
+    def search(cls, term, after=None, candidates=None):
+        """Query for (message, rank) pairs whose text matches `term`, best
+        match first, authors loaded alongside. Postgres only: needs the
+        search_vector column (see install_full_text_search).
+
+        `after` is the (rank, id) of the last result already shown; only
+        results ranked below it are returned.
+
+        Ranking means scoring every match, which for a common word is much
+        of the table. Given `candidates`, only that many of the newest
+        matches are ranked, so the cost stays flat however common the term.
+        """
+
+        tsquery = db.func.plainto_tsquery('english', term)
+        vector = db.literal_column('messages.search_vector')
+        rank = db.func.ts_rank(vector, tsquery)
+
+        query = (db.session.query(cls, rank)
+                 .filter(vector.op('@@')(tsquery))
+                 .options(db.joinedload(cls.user)))
+
+        if candidates:
+            newest = (db.session.query(cls.id)
+                      .filter(vector.op('@@')(tsquery))
+                      .order_by(cls.id.desc())
+                      .limit(candidates)
+                      .subquery())
+            query = query.filter(cls.id.in_(select([newest.c.id])))
+
+        if after:
+            after_rank, after_id = after
+            query = query.filter(db.tuple_(rank, cls.id)
+                                 < db.tuple_(db.cast(after_rank, db.REAL), after_id))
+
+        return query.order_by(rank.desc(), cls.id.desc())
+
+    @classmethod
+    def like_counts(cls, messages):
+        """Total likes for each of `messages`, as a dict keyed by message id.
+
+        One query, and only if some of the messages use sharded counting.
+        """
+
+        counts = {msg.id: msg.like_count for msg in messages}
+        sharded = [msg.id for msg in messages if msg.sharded_likes]
+
+        if sharded:
+            shard_totals = (db.session
+                            .query(MessageLikeShard.message_id,
+                                   db.func.sum(MessageLikeShard.count))
+                            .filter(MessageLikeShard.message_id.in_(sharded))
+                            .group_by(MessageLikeShard.message_id))
+            for message_id, total in shard_totals:
+                counts[message_id] += total
+
+        return counts
+
+    @classmethod
+    def recount_likes(cls):
+        """Recompute every message's like count and clear its shards."""
+
+        likes = (select([db.func.count()])
+                 .select_from(Likes.__table__)
+                 .where(Likes.message_id == cls.id)
+                 .as_scalar())
+
+        db.session.execute(cls.__table__.update().values(like_count=likes))
+        db.session.execute(
+            MessageLikeShard.__table__.update().values(count=0))
+
+
+class MessageLikeShard(db.Model):
+    """One slice of a popular message's like count.
+
+    Every like of a message bumps the same messages row, so likes of a
+    viral message queue up on that row's lock. Once a message is sharded,
+    each like instead bumps one of SHARDS rows picked at random, and the
+    total is messages.like_count plus the shard counts.
+    """
+
+    __tablename__ = 'message_like_shards'
+
+    SHARDS = 16
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Integer,
+        primary_key=True,
+        autoincrement=False,
+    )
+
+    count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    @classmethod
+    def enable(cls, message_id):
+        """Switch `message_id` over to sharded like counting."""
+
+        updated = (Message.query
+                   .filter_by(id=message_id, sharded_likes=False)
+                   .update({Message.sharded_likes: True},
+                           synchronize_session=False))
+
+        # If someone else got here first, their shards are already in place
+        if updated:
+            db.session.bulk_insert_mappings(cls, [
+                dict(message_id=message_id, shard=shard, count=0)
+                for shard in range(cls.SHARDS)
+            ])
+
+    @classmethod
+    def adjust(cls, connection, message_id, delta):
+        """Add `delta` to the like count of `message_id`."""
+
+        messages = Message.__table__
+        result = connection.execute(
+            messages.update()
+            .where(messages.c.id == message_id)
+            .where(messages.c.sharded_likes == db.false())
+            .values(like_count=messages.c.like_count + delta))
+
+        if not result.rowcount:
+            shards = cls.__table__
+            connection.execute(
+                shards.update()
+                .where(shards.c.message_id == message_id)
+                .where(shards.c.shard == random.randrange(cls.SHARDS))
+                .values(count=shards.c.count + delta))
+
+    @classmethod
+    def remove_likes(cls, connection, message_ids):
+        """Take one like off the count of each of `message_ids` (a list or
+        a SELECT of ids).
+
+        A sharded message loses it from its lowest shard that has likes, so
+        no shard goes negative, or from messages.like_count once fold() has
+        emptied them all.
+        """
+
+        messages = Message.__table__
+        shards = cls.__table__
+        others = shards.alias()
+
+        has_shard_likes = db.exists(
+            select([others.c.shard])
+            .where(others.c.message_id == messages.c.id)
+            .where(others.c.count > 0))
+        connection.execute(
+            messages.update()
+            .where(messages.c.id.in_(message_ids))
+            .where(db.or_(messages.c.sharded_likes == db.false(),
+                          ~has_shard_likes))
+            .values(like_count=messages.c.like_count - 1))
+
+        lowest = (select([db.func.min(others.c.shard)])
+                  .where(others.c.message_id == shards.c.message_id)
+                  .where(others.c.count > 0)
+                  .as_scalar())
+        connection.execute(
+            shards.update()
+            .where(shards.c.message_id.in_(message_ids))
+            .where(shards.c.shard == lowest)
+            .values(count=shards.c.count - 1))
+
+    @classmethod
+    def fold(cls):
+        """Move shard counts back into messages.like_count.
+
+        Locks the shard rows while it works so no concurrent like is lost.
+        """
+
+        totals = {}
+        for shard in cls.query.with_for_update():
+            totals[shard.message_id] = totals.get(shard.message_id, 0) + shard.count
+            shard.count = 0
+
+        for message_id, total in totals.items():
+            Message.query.filter_by(id=message_id).update(
+                {Message.like_count: Message.like_count + total},
+                synchronize_session=False)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline.
+
+    Every message is fanned out to its author and to each of the author's
+    followers when it is written, so building a home page is a single
+    range read of the (user_id, message_id) primary key, which is in time
+    order since message ids are.
+    """
+
+    __tablename__ = 'timeline_entries'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message = db.relationship('Message')
+
+    @staticmethod
+    def _sources():
+        """SELECTs producing (reader, message) rows for timelines.
+
+        One covers authors reading their own messages, the other followers
+        reading the messages of everyone they follow.
+        """
+
+        own = select([Message.user_id, Message.id])
+        followed = (select([Follows.user_following_id, Message.id])
+                    .select_from(Follows.__table__.join(
+                        Message.__table__,
+                        Message.user_id == Follows.user_being_followed_id))
+                    # Authors already read their own messages via `own`
+                    .where(Follows.user_following_id
+                           != Follows.user_being_followed_id))
+        return own, followed
+
+    @classmethod
+    def fan_out(cls, connection, message_id):
+        """Add a new message to the timelines of its author and followers."""
+
+        for source in cls._sources():
+            connection.execute(
+                cls.__table__.insert().from_select(
+                    ['user_id', 'message_id'],
+                    source.where(Message.id == message_id)))
+
+    @classmethod
+    def backfill(cls, connection, follower_id, followed_id):
+        """Copy `followed_id`'s existing messages into `follower_id`'s timeline."""
+
+        if follower_id == followed_id:
+            return
+
+        messages = (select([literal(follower_id), Message.id])
+                    .where(Message.user_id == followed_id))
+
+        connection.execute(
+            cls.__table__.insert().from_select(
+                ['user_id', 'message_id'], messages))
+
+    @classmethod
+    def remove(cls, connection, follower_id, followed_id):
+        """Drop `followed_id`'s messages from `follower_id`'s timeline."""
+
+        # Users always see their own messages
+        if follower_id == followed_id:
+            return
+
+        authored = select([Message.id]).where(Message.user_id == followed_id)
+
+        connection.execute(
+            cls.__table__.delete()
+            .where(cls.user_id == follower_id)
+            .where(cls.message_id.in_(authored)))
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every timeline from `messages` and `follows`.
+
+        Needed after bulk loads (like seed.py) that bypass the ORM events
+        which normally keep timelines up to date.
+        """
+
+        db.session.execute(cls.__table__.delete())
+        for source in cls._sources():
+            db.session.execute(
+                cls.__table__.insert().from_select(
+                    ['user_id', 'message_id'], source))
+
+
+##############################################################################
+# Password hashing
+#
+# bcrypt costs about 250ms of CPU a hash at its default cost of 12, set by
+# BCRYPT_LOG_ROUNDS. Hashing runs on a pool of BCRYPT_THREADS threads
+# (default: one per CPU), which only limits how many hashes run at once: a
+# burst of logins queues for the pool instead of oversubscribing the CPUs.
+# The request thread still waits for its hash. bcrypt's C code releases
+# the GIL, so other requests keep running meanwhile.
+
+hash_pool = None
+hash_pool_lock = threading.Lock()
+
+
+def app_config(name, default):
+    """`name` from the app's config, or `default` outside of any app."""
+
+    try:
+        return db.get_app().config.get(name, default)
+    except RuntimeError:
+        return default
+
+
+def get_hash_pool():
+    """The bcrypt thread pool, started on first use."""
+
+    global hash_pool
+
+    if hash_pool is None:
+        with hash_pool_lock:
+            if hash_pool is None:
+                hash_pool = ThreadPoolExecutor(
+                    app_config('BCRYPT_THREADS', os.cpu_count()),
+                    thread_name_prefix='bcrypt')
+
+    return hash_pool
+
+
+def bcrypt_rounds():
+    """The configured bcrypt cost (BCRYPT_LOG_ROUNDS)."""
+
+    return app_config('BCRYPT_LOG_ROUNDS', 12)
+
+
+def hash_password(password):
+    """bcrypt hash of `password`, at a cost of BCRYPT_LOG_ROUNDS."""
+
+    hashed = get_hash_pool().submit(
+        bcrypt.generate_password_hash, password, bcrypt_rounds()).result()
+    return hashed.decode('UTF-8')
+
+
+def check_password(hashed, password):
+    """Does `password` match the bcrypt hash `hashed`?"""
+
+    return get_hash_pool().submit(
+        bcrypt.check_password_hash, hashed, password).result()
+
+
+def hash_cost(hashed):
+    """The log rounds a bcrypt hash was made with ("$2b$12$..." -> 12)."""
+
+    return int(hashed.split('$')[2])
+
+
+##############################################################################
+# Trigram search of usernames (Postgres only)
+#
+# pg_trgm ships in Postgres contrib, which not every install has, so it is
+# set up only where available and User.search() copes without it.
+
+
+def install_trigram_search(connection):
+    """Enable pg_trgm and index users.username with it, where possible."""
+
+    if connection.dialect.name != 'postgresql':
+        return
+
+    available = connection.execute(
+        "SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'").scalar()
+    if not available:
+        return
+
+    connection.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_users_username_trgm "
+        "ON users USING gin (username gin_trgm_ops)")
+    has_trigram_search.cache_clear()
+
+
+@functools.lru_cache()
+def has_trigram_search(engine):
+    """Is pg_trgm installed in the database behind `engine`?"""
+
+    return bool(engine.execute(
+        "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'").scalar())
+
+
+@event.listens_for(User.__table__, 'after_create')
+def users_table_created(target, connection, **kw):
+    install_trigram_search(connection)
+
+
+##############################################################################
+# Full-text search of messages (Postgres 12+)
+#
+# A generated tsvector column keeps every message's search terms next to its
+# text, and a GIN index over it finds matches without reading the table. It
+# lives outside the model because SQLAlchemy can't declare it portably.
+
+
+def install_full_text_search(connection):
+    """Add and index messages.search_vector, where the server supports it."""
+
+    if (connection.dialect.name != 'postgresql'
+            or connection.dialect.server_version_info < (12,)):
+        return
+
+    connection.execute(
+        "ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('english', text)) STORED")
+    connection.execute(
+        "CREATE INDEX IF NOT EXISTS ix_messages_search_vector "
+        "ON messages USING gin (search_vector)")
+    has_full_text_search.cache_clear()
+
+
+@functools.lru_cache()
+def has_full_text_search(engine):
+    """Does the database behind `engine` have messages.search_vector?"""
+
+    if engine.dialect.name != 'postgresql':
+        return False
+
+    return bool(engine.execute(
+        "SELECT 1 FROM information_schema.columns "
+        "WHERE table_name = 'messages' AND column_name = 'search_vector'").scalar())
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def messages_table_created(target, connection, **kw):
+    install_full_text_search(connection)
+
+
+##############################################################################
+# Keep materialized timelines and user counters in step with messages,
+# follows and likes.
+
+
+def adjust_counts(connection, user_ids, **deltas):
+    """Add `deltas` (e.g. messages_count=1) to the counters of `user_ids`,
+    bumping their versions.
+
+    `user_ids` may be a single id or a SELECT of ids. Counters only follow
+    writes of Follows, Likes and Message rows, which is why the matching
+    relationships on User are read only.
+    """
+
+    users = User.__table__
+    if isinstance(user_ids, int):
+        condition = users.c.id == user_ids
+    else:
+        condition = users.c.id.in_(user_ids)
+
+    values = {users.c[name]: users.c[name] + delta
+              for name, delta in deltas.items()}
+    values[users.c.version] = users.c.version + 1
+
+    update = users.update().where(condition).values(values)
+    if connection.dialect.implicit_returning:
+        for user_id, version in connection.execute(
+                update.returning(users.c.id, users.c.version)):
+            known_versions.set(user_id, version)
+    else:
+        connection.execute(update)
+
+
+@event.listens_for(Message, 'after_insert')
+def message_added(mapper, connection, message):
+    TimelineEntry.fan_out(connection, message.id)
+    adjust_counts(connection, message.user_id, messages_count=1)
+
+
+@event.listens_for(Message, 'before_delete')
+def message_deleted(mapper, connection, message):
+    # Likes of this message disappear with it (ON DELETE CASCADE)
+    likers = select([Likes.user_id]).where(Likes.message_id == message.id)
+    adjust_counts(connection, likers, likes_count=-1)
+    adjust_counts(connection, message.user_id, messages_count=-1)
+
+
+@event.listens_for(Follows, 'after_insert')
+def follow_added(mapper, connection, follow):
+    TimelineEntry.backfill(
+        connection, follow.user_following_id, follow.user_being_followed_id)
+    adjust_counts(connection, follow.user_following_id, following_count=1)
+    adjust_counts(connection, follow.user_being_followed_id, followers_count=1)
+
+
+@event.listens_for(Follows, 'after_delete')
+def follow_deleted(mapper, connection, follow):
+    TimelineEntry.remove(
+        connection, follow.user_following_id, follow.user_being_followed_id)
+    adjust_counts(connection, follow.user_following_id, following_count=-1)
+    adjust_counts(connection, follow.user_being_followed_id, followers_count=-1)
+
+
+@event.listens_for(Likes, 'after_insert')
+def like_added(mapper, connection, like):
+    adjust_counts(connection, like.user_id, likes_count=1)
+    MessageLikeShard.adjust(connection, like.message_id, 1)
+
+
+@event.listens_for(Likes, 'after_delete')
+def like_deleted(mapper, connection, like):
+    adjust_counts(connection, like.user_id, likes_count=-1)
+    MessageLikeShard.remove_likes(connection, [like.message_id])
+
+
+@event.listens_for(User, 'before_delete')
+def user_deleted(mapper, connection, user):
+    known_versions.set(user.id, 0)
+
+    # The user's follows, likes, messages and their likes disappear with the
+    # user (ON DELETE CASCADE), so settle the counters of everything they
+    # touched.
+    followed = (select([Follows.user_being_followed_id])
+                .where(Follows.user_following_id == user.id))
+    followers = (select([Follows.user_following_id])
+                 .where(Follows.user_being_followed_id == user.id))
+    adjust_counts(connection, followed, followers_count=-1)
+    adjust_counts(connection, followers, following_count=-1)
+
+    users = User.__table__
+    lost_likes = (select([db.func.count()])
+                  .select_from(Likes.__table__.join(Message.__table__))
+                  .where(Message.user_id == user.id)
+                  .where(Likes.user_id == users.c.id)
+                  .as_scalar())
+    likers = (select([Likes.user_id])
+              .select_from(Likes.__table__.join(Message.__table__))
+              .where(Message.user_id == user.id))
+    connection.execute(
+        users.update()
+        .where(users.c.id.in_(likers))
+        .values(likes_count=users.c.likes_count - lost_likes,
+                version=users.c.version + 1))
+
+    # And the like counts of the messages they liked
+    MessageLikeShard.remove_likes(
+        connection, select([Likes.message_id]).where(Likes.user_id == user.id))
+
+
+def upgrade_db(connection=None):
+    """Bring an existing database up to date with these models.
+
+    Creates any missing tables, columns, indexes and unique constraints,
+    widens INTEGER columns the models now declare as BIGINT and, on
+    Postgres, drops unique constraints the models no longer declare. Never
+    drops tables, columns or data. New columns need a server default (or to
+    be nullable) so existing rows can be filled in.
+
+    Runs in a transaction of its own, or of `connection` if given.
+    """
+
+    if connection is None:
+        with db.engine.begin() as connection:
+            return upgrade_db(connection)
+
+    db.metadata.create_all(connection)
+
+    inspector = inspect(connection)
+    for table in db.metadata.sorted_tables:
+        columns = {c['name']: c for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                connection.execute(f"ALTER TABLE {table.name} ADD COLUMN {ddl}")
+
+            elif (isinstance(column.type, db.BigInteger)
+                  and not isinstance(columns[column.name]['type'], db.BigInteger)
+                  and connection.dialect.name == 'postgresql'):
+                connection.execute(f"ALTER TABLE {table.name} "
+                                   f"ALTER COLUMN {column.name} TYPE BIGINT")
+
+        indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(connection)
+
+        declared = {frozenset(c.name for c in constraint.columns): constraint
+                    for constraint in table.constraints
+                    if isinstance(constraint, db.UniqueConstraint)}
+        declared.update({frozenset([c.name]): None
+                         for c in table.columns if c.unique})
+        existing = {frozenset(u['column_names']): u['name']
+                    for u in inspector.get_unique_constraints(table.name)}
+
+        for columns, constraint in declared.items():
+            if columns not in existing and constraint is not None:
+                connection.execute(AddConstraint(constraint))
+
+        if connection.dialect.name == 'postgresql':
+            for columns, name in existing.items():
+                if columns not in declared:
+                    connection.execute(
+                        f"ALTER TABLE {table.name} DROP CONSTRAINT {name}")
+
+    install_trigram_search(connection)
+    install_full_text_search(connection)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -208,3 +1050,6 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+
+    app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+    app.config.setdefault('BCRYPT_THREADS', os.cpu_count())
@@ -0,0 +1,99 @@
+"""Run Warbler's test modules in parallel, each against its own database.
+
+Builds a template database with the current schema, clones a database per
+test module from it (CREATE DATABASE ... TEMPLATE copies files, far faster
+than creating the tables again), runs the modules side by side and drops
+the clones afterwards.
+
+Run it like:
+
+    python runtests.py [--jobs 4] [--database postgresql:///warbler_test] \
+        [test_user_views.py ...]
+
+The template and clones are named after --database, with suffixes.
+"""
+
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('modules', nargs='*')
+parser.add_argument('--jobs', type=int, default=os.cpu_count())
+parser.add_argument('--database',
+                    default=os.environ.get('DATABASE_URL', 'postgresql:///warbler_test'))
+args = parser.parse_args()
+
+
+def url_for_database(name):
+    """--database, with the database name swapped for `name`."""
+
+    url = make_url(args.database)
+    url.database = name
+    return url
+
+
+def run(command, database):
+    """Run `command` against `database`; returns (returncode, output)."""
+
+    env = dict(os.environ,
+               DATABASE_URL=str(url_for_database(database)),
+               FLASK_ENV=os.environ.get('FLASK_ENV', 'production'))
+    result = subprocess.run(command, env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, text=True)
+    return result.returncode, result.stdout
+
+
+def main():
+    modules = args.modules or sorted(glob.glob('test_*.py'))
+    server = create_engine(url_for_database('postgres'),
+                           isolation_level='AUTOCOMMIT')
+
+    base = make_url(args.database).database
+    template = f"{base}_template"
+    clones = [f"{base}_{i}" for i in range(len(modules))]
+
+    def recreate(name, template=None):
+        server.execute(f'DROP DATABASE IF EXISTS "{name}"')
+        server.execute(f'CREATE DATABASE "{name}"'
+                       + (f' TEMPLATE "{template}"' if template else ''))
+
+    start = time.perf_counter()
+    try:
+        # Importing testing creates the tables
+        recreate(template)
+        returncode, output = run([sys.executable, '-c', 'import testing'], template)
+        if returncode:
+            sys.exit(output)
+
+        for clone in clones:
+            recreate(clone, template)
+
+        with ThreadPoolExecutor(args.jobs) as pool:
+            results = list(pool.map(
+                lambda job: run([sys.executable, '-m', 'unittest', job[0][:-3]], job[1]),
+                zip(modules, clones)))
+
+    finally:
+        for name in clones + [template]:
+            server.execute(f'DROP DATABASE IF EXISTS "{name}"')
+
+    failed = [module for module, (returncode, _) in zip(modules, results) if returncode]
+    for module, (_, output) in zip(modules, results):
+        print(f"== {module}")
+        print(output)
+
+    print(f"{len(modules)} modules in {time.perf_counter() - start:.1f}s, "
+          f"{len(failed)} failed{': ' + ', '.join(failed) if failed else ''}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
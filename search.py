@@ -0,0 +1,371 @@
+"""In-process search indexes for Warbler.
+
+These answer lookups from worker memory: username typeahead, at keystroke
+rate, so it never reaches Postgres, and message search on databases with no
+full-text search of their own.
+"""
+
+import bisect
+import heapq
+import re
+import threading
+import time
+from array import array
+from collections import Counter, defaultdict
+
+WORD = re.compile(r'\w+')
+
+
+def tokenize(text):
+    """The lowercased words of `text`."""
+
+    return WORD.findall(text.lower())
+
+
+class ReloadingIndex:
+    """Holds an index made by `load()`: built on first use, and built again
+    once it is `ttl` seconds old (never, if None), to catch up on changes
+    made elsewhere, like in other worker processes.
+
+    Only one thread builds at a time. Callers wait for the first build, but
+    during a reload they keep using the old index. Changes passed through
+    update() while a build runs are replayed onto the new index before it
+    takes over.
+    """
+
+    def __init__(self, load, ttl=None):
+        self.load = load
+        self.ttl = ttl
+
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._index = None
+        self._loaded_at = 0
+        self._pending = None
+
+    @property
+    def loaded(self):
+        """The index, or None if it hasn't been built yet."""
+
+        return self._index
+
+    def get(self):
+        """The index, building it first if it's missing or too old."""
+
+        index = self._index
+        if index is not None and (
+                self.ttl is None or time.time() - self._loaded_at < self.ttl):
+            return index
+
+        if not self._build_lock.acquire(blocking=index is None):
+            return index
+
+        try:
+            if self._index is not index:
+                # Another thread built it while this one waited
+                return self._index
+
+            with self._lock:
+                self._pending = []
+            try:
+                new = self.load()
+            except BaseException:
+                with self._lock:
+                    self._pending = None
+                raise
+
+            with self._lock:
+                for method, args in self._pending:
+                    getattr(new, method)(*args)
+                self._pending = None
+                self._index = new
+                self._loaded_at = time.time()
+            return new
+
+        finally:
+            self._build_lock.release()
+
+    def update(self, method, *args):
+        """Call the index's `method` with `args`, if the index is built or
+        being built."""
+
+        with self._lock:
+            index = self._index
+            if self._pending is not None:
+                self._pending.append((method, args))
+
+        if index is not None:
+            getattr(index, method)(*args)
+
+    def reset(self):
+        """Drop the index, so the next get() builds it afresh."""
+
+        with self._lock:
+            self._index = None
+
+
+class UsernameIndex:
+    """Compact sorted index of usernames for case-insensitive prefix lookups.
+
+    Usernames live UTF-8 encoded, back to back, in one bytes blob, sorted by
+    (lowercased name, user id), next to arrays of their offsets and user
+    ids. That costs the name's length plus 12 bytes per user, so millions of
+    usernames fit in tens of megabytes, where a dict or trie of Python
+    strings would take several times that.
+
+    Changes land in a small sorted overlay (additions) and a tombstone set
+    (removals) and are merged into the blob once the overlay reaches
+    `merge_threshold` entries, without holding up suggestions meanwhile.
+    """
+
+    def __init__(self, users=(), merge_threshold=1024):
+        self.merge_threshold = merge_threshold
+        self._lock = threading.Lock()
+        self._overlay = []
+        self._tombstones = set()
+        self._merging = False
+        self._load(sorted((name.lower(), user_id, name)
+                          for user_id, name in users))
+
+    def __len__(self):
+        return len(self._ids) + len(self._overlay) - len(self._tombstones)
+
+    def _load(self, entries):
+        """Replace the blob with `entries`: sorted (key, id, name) tuples."""
+
+        blob = bytearray()
+        offsets = array('I', [0])
+        ids = array('q')
+
+        for _, user_id, name in entries:
+            blob += name.encode('utf-8')
+            offsets.append(len(blob))
+            ids.append(user_id)
+
+        self._blob = bytes(blob)
+        self._offsets = offsets
+        self._ids = ids
+
+    def _name_at(self, i):
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].decode('utf-8')
+
+    def _base_from(self, key):
+        """(key, id, name) entries of the blob, starting at the first >= key."""
+
+        lo, hi = 0, len(self._ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name_at(mid).lower() < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        for i in range(lo, len(self._ids)):
+            name = self._name_at(i)
+            yield name.lower(), self._ids[i], name
+
+    def _entries_from(self, key):
+        """All live (key, id, name) entries, in order, from the first >= key."""
+
+        start = bisect.bisect_left(self._overlay, (key,))
+        merged = heapq.merge(self._base_from(key), self._overlay[start:])
+
+        for entry in merged:
+            if entry not in self._tombstones:
+                yield entry
+
+    def _position(self, entry, blob, offsets, ids):
+        """Index of the first blob entry >= `entry`: a (key, id, name)."""
+
+        lo, hi = 0, len(ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = blob[offsets[mid]:offsets[mid + 1]].decode('utf-8')
+            if (name.lower(), ids[mid], name) < entry:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _in_base(self, entry):
+        i = self._position(entry, self._blob, self._offsets, self._ids)
+        return (i < len(self._ids) and self._ids[i] == entry[1]
+                and self._name_at(i) == entry[2])
+
+    def _merge(self):
+        """Fold the overlay and tombstones into the blob.
+
+        The new blob is spliced together outside the lock, copying the old
+        one in runs between the changed entries rather than decoding every
+        name, so suggestions carry on meanwhile. Changes made during the
+        merge are kept in the overlay and tombstones.
+        """
+
+        with self._lock:
+            if self._merging:
+                return
+            self._merging = True
+            blob, offsets, ids = self._blob, self._offsets, self._ids
+            overlay, tombstones = list(self._overlay), set(self._tombstones)
+
+        try:
+            # (position in the old blob, 0 to insert before it or 1 to drop
+            # it, entry)
+            changes = [(self._position(entry, blob, offsets, ids), 0, entry)
+                       for entry in overlay]
+            for entry in tombstones:
+                i = self._position(entry, blob, offsets, ids)
+                if (i < len(ids) and ids[i] == entry[1]
+                        and blob[offsets[i]:offsets[i + 1]] == entry[2].encode('utf-8')):
+                    changes.append((i, 1, entry))
+            changes.sort()
+
+            new_blob = bytearray()
+            new_offsets = array('I', [0])
+            new_ids = array('q')
+
+            def copy(start, end):
+                if start < end:
+                    shift = len(new_blob) - offsets[start]
+                    new_blob.extend(blob[offsets[start]:offsets[end]])
+                    new_offsets.extend(o + shift for o in offsets[start + 1:end + 1])
+                    new_ids.extend(ids[start:end])
+
+            i = 0
+            for position, drop, entry in changes:
+                copy(i, position)
+                i = position
+                if drop:
+                    i += 1
+                else:
+                    new_blob.extend(entry[2].encode('utf-8'))
+                    new_offsets.append(len(new_blob))
+                    new_ids.append(entry[1])
+            copy(i, len(ids))
+
+            with self._lock:
+                self._blob = bytes(new_blob)
+                self._offsets = new_offsets
+                self._ids = new_ids
+
+                # Keep what changed while the new blob was being built: an
+                # overlay entry removed meanwhile is now in the blob, and a
+                # tombstone lifted meanwhile was re-added
+                current = set(self._overlay)
+                merged = set(overlay)
+                self._overlay = [e for e in self._overlay if e not in merged]
+                for entry in tombstones - self._tombstones:
+                    bisect.insort(self._overlay, entry)
+                self._tombstones = (
+                    (self._tombstones - tombstones)
+                    | {e for e in overlay if e not in current})
+        finally:
+            with self._lock:
+                self._merging = False
+
+    def add(self, user_id, username):
+        """Index `username` for `user_id`. Adding it twice does nothing."""
+
+        entry = (username.lower(), user_id, username)
+        with self._lock:
+            if entry in self._tombstones:
+                # Re-adding something removed since the last merge
+                self._tombstones.discard(entry)
+            else:
+                i = bisect.bisect_left(self._overlay, entry)
+                if ((i < len(self._overlay) and self._overlay[i] == entry)
+                        or self._in_base(entry)):
+                    return
+                self._overlay.insert(i, entry)
+
+            full = len(self._overlay) >= self.merge_threshold
+
+        if full:
+            self._merge()
+
+    def remove(self, user_id, username):
+        """Stop returning `username` for `user_id`."""
+
+        entry = (username.lower(), user_id, username)
+        with self._lock:
+            i = bisect.bisect_left(self._overlay, entry)
+            if i < len(self._overlay) and self._overlay[i] == entry:
+                del self._overlay[i]
+            else:
+                self._tombstones.add(entry)
+
+    def rename(self, user_id, old_username, new_username):
+        """Move `user_id` from `old_username` to `new_username`."""
+
+        self.remove(user_id, old_username)
+        self.add(user_id, new_username)
+
+    def suggest(self, prefix, limit=10):
+        """Up to `limit` (user_id, username) pairs whose username starts
+        with `prefix`, ignoring case, in alphabetical order."""
+
+        key = prefix.lower()
+        if not key:
+            return []
+
+        suggestions = []
+        with self._lock:
+            for entry_key, user_id, name in self._entries_from(key):
+                if not entry_key.startswith(key) or len(suggestions) == limit:
+                    break
+                suggestions.append((user_id, name))
+
+        return suggestions
+
+
+class MessageIndex:
+    """Inverted index of message text, for databases without full-text
+    search (Postgres before 12, SQLite).
+
+    Maps each word to the ids of the messages using it and how many times.
+    A search matches messages containing every word of the query, ranked by
+    how often those words occur, newest (highest id) first among equals.
+    """
+
+    def __init__(self, messages=()):
+        self._lock = threading.Lock()
+        self._postings = defaultdict(dict)
+
+        for message_id, text in messages:
+            self.add(message_id, text)
+
+    def add(self, message_id, text):
+        """Index `text` as the text of `message_id`."""
+
+        with self._lock:
+            for word, count in Counter(tokenize(text)).items():
+                self._postings[word][message_id] = count
+
+    def remove(self, message_id, text):
+        """Forget `message_id`, which had `text`."""
+
+        with self._lock:
+            for word in set(tokenize(text)):
+                postings = self._postings.get(word)
+                if postings is not None:
+                    postings.pop(message_id, None)
+                    if not postings:
+                        del self._postings[word]
+
+    def search(self, query):
+        """(rank, message_id) pairs of the messages matching every word of
+        `query`, best first."""
+
+        words = set(tokenize(query))
+        if not words:
+            return []
+
+        with self._lock:
+            postings = sorted((self._postings.get(word, {}) for word in words),
+                              key=len)
+            ranked = [(sum(p[message_id] for p in postings), message_id)
+                      for message_id in postings[0]
+                      if all(message_id in p for p in postings[1:])]
+
+        ranked.sort(reverse=True)
+        return ranked
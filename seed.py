@@ -1,8 +1,10 @@
 """Seed database with sample data from CSV Files."""
 
 from csv import DictReader
+from datetime import datetime
 from app import db
-from models import User, Message, Follows
+from models import User, Message, Follows, TimelineEntry
+from snowflake import make_id, MAX_SEQUENCE
 
 
 db.drop_all()
@@ -11,10 +13,21 @@ db.create_all()
 with open('generator/users.csv') as users:
     db.session.bulk_insert_mappings(User, DictReader(users))
 
+# Give historical messages ids from their own timestamps, so id order
+# stays time order
 with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    rows = list(DictReader(messages))
+    for sequence, row in enumerate(rows):
+        timestamp = datetime.fromisoformat(row['timestamp'])
+        row['id'] = make_id(timestamp, sequence=sequence & MAX_SEQUENCE)
+    db.session.bulk_insert_mappings(Message, rows)
 
 with open('generator/follows.csv') as follows:
     db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+# Bulk inserts skip the ORM events that fan messages out to timelines
+# and keep user counts current
+TimelineEntry.rebuild()
+User.recount()
+
 db.session.commit()
@@ -0,0 +1,125 @@
+"""Time-sortable 64-bit ids for Warbler.
+
+Ids are built like Twitter's snowflakes:
+
+    41 bits: milliseconds since EPOCH
+    10 bits: worker id
+    12 bits: sequence number within the millisecond
+
+so sorting by id sorts by creation time, and every worker can mint ids
+without coordinating through a database sequence.
+
+Every process minting ids needs a worker id of its own: set
+WARBLER_WORKER_ID, from 0 to 1023 and different in each, for any server
+that runs more than one process (gunicorn with several workers, say),
+whether or not it sets WEB_CONCURRENCY.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+EPOCH = datetime(2010, 1, 1)
+EPOCH_SECONDS = (EPOCH - datetime(1970, 1, 1)).total_seconds()
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+def make_id(timestamp, worker=0, sequence=0):
+    """Build the id for `timestamp` (a naive UTC datetime)."""
+
+    millis = int((timestamp - EPOCH).total_seconds() * 1000)
+    return ((millis << (WORKER_BITS + SEQUENCE_BITS))
+            | (worker << SEQUENCE_BITS)
+            | sequence)
+
+
+def timestamp_of(snowflake_id):
+    """The (millisecond precision) creation time encoded in an id."""
+
+    millis = snowflake_id >> (WORKER_BITS + SEQUENCE_BITS)
+    return EPOCH + timedelta(milliseconds=millis)
+
+
+class SnowflakeGenerator:
+    """Thread-safe id source for one worker process."""
+
+    def __init__(self, worker):
+        if not 0 <= worker <= MAX_WORKER:
+            raise ValueError(f"worker must be between 0 and {MAX_WORKER}")
+
+        self.worker = worker
+        self._lock = threading.Lock()
+        self._last_millis = -1
+        self._sequence = 0
+
+    def _millis(self):
+        return int((time.time() - EPOCH_SECONDS) * 1000)
+
+    def next_id(self):
+        """A new id, greater than every id this generator made before."""
+
+        with self._lock:
+            millis = self._millis()
+
+            # Never go backwards, even if the wall clock does
+            if millis < self._last_millis:
+                millis = self._last_millis
+
+            if millis == self._last_millis:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Used up this millisecond; wait for the next one
+                    while millis <= self._last_millis:
+                        millis = self._millis()
+            else:
+                self._sequence = 0
+
+            self._last_millis = millis
+            return ((millis << (WORKER_BITS + SEQUENCE_BITS))
+                    | (self.worker << SEQUENCE_BITS)
+                    | self._sequence)
+
+
+def worker_id(environ=os.environ):
+    """This process's worker id, from WARBLER_WORKER_ID.
+
+    Every process minting ids needs a worker id of its own, or two of them
+    can hand out the same id in the same millisecond. Without
+    WARBLER_WORKER_ID, the process is taken to be the only one and is
+    worker 0; if WEB_CONCURRENCY says otherwise, that's a RuntimeError.
+    Servers that start several processes without setting WEB_CONCURRENCY
+    can't be detected, so they must set WARBLER_WORKER_ID themselves.
+    """
+
+    if 'WARBLER_WORKER_ID' in environ:
+        return int(environ['WARBLER_WORKER_ID'])
+
+    if int(environ.get('WEB_CONCURRENCY', 1)) > 1:
+        raise RuntimeError(
+            "WEB_CONCURRENCY is above 1: give each worker process its own "
+            f"WARBLER_WORKER_ID, from 0 to {MAX_WORKER}")
+
+    return 0
+
+
+generator = None
+generator_lock = threading.Lock()
+
+
+def next_id():
+    """A new id from this process's generator."""
+
+    global generator
+
+    if generator is None:
+        with generator_lock:
+            if generator is None:
+                generator = SnowflakeGenerator(worker_id())
+
+    return generator.next_id()
@@ -0,0 +1,99 @@
+"""Page cache tests."""
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from caching import LRUCache, Page, PageCache
+
+
+def page(body):
+    return Page(200, [["Content-Type", "text/html"]], body)
+
+
+class LRUCacheTestCase(TestCase):
+    """Test the in-process LRU."""
+
+    def test_no_ttl(self):
+        cache = LRUCache(max_entries=2)
+        cache.set((1, 1), "card one")
+        cache.set((2, 1), "card two")
+        self.assertEqual(cache.get((1, 1)), "card one")
+
+        cache.set((2, 2), "card two, author edited")
+        self.assertIsNone(cache.get((2, 1)))
+        self.assertEqual(cache.get((1, 1)), "card one")
+
+
+    def test_stale_set(self):
+        """Values read before their tags were invalidated aren't stored."""
+
+        cache = LRUCache()
+        started = time.time()
+        cache.invalidate("user:1")
+        cache.set("/users/1", "old profile", ["user:1"], since=started)
+        self.assertIsNone(cache.get("/users/1"))
+
+        cache.set("/users/1", "new profile", ["user:1"], since=time.time())
+        self.assertEqual(cache.get("/users/1"), "new profile")
+
+
+class PageCacheTestCase(TestCase):
+    """Test the server side page cache."""
+
+    def test_lru(self):
+        cache = PageCache(max_entries=2)
+        cache.set("/a", page(b"a"))
+        cache.set("/b", page(b"b"))
+        cache.get("/a")
+        cache.set("/c", page(b"c"))
+
+        self.assertEqual(cache.get("/a").body, b"a")
+        self.assertIsNone(cache.get("/b"))
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        cache = PageCache(ttl=0)
+        cache.set("/a", page(b"a"))
+        self.assertIsNone(cache.get("/a"))
+
+    def test_invalidate(self):
+        cache = PageCache()
+        cache.set("/users/1", page(b"profile"), ["user:1"])
+        cache.set("/messages/5", page(b"message"), ["message:5", "user:1"])
+        cache.set("/users/2", page(b"other"), ["user:2"])
+
+        cache.invalidate("message:5")
+        self.assertIsNone(cache.get("/messages/5"))
+        self.assertIsNotNone(cache.get("/users/1"))
+
+        cache.invalidate("user:1")
+        self.assertIsNone(cache.get("/users/1"))
+        self.assertIsNotNone(cache.get("/users/2"))
+
+    def test_shared_tier(self):
+        """Workers sharing a SQLite file see each other's pages."""
+
+        path = os.path.join(tempfile.mkdtemp(), "pages.db")
+        worker1 = PageCache(path=path)
+        worker2 = PageCache(path=path)
+
+        worker1.set("/users/1", page(b"profile"), ["user:1"])
+        self.assertEqual(worker2.get("/users/1"), page(b"profile"))
+
+        worker1.set("/users/2", page(b"other"), ["user:2"])
+        worker2.invalidate("user:2")
+        self.assertIsNone(PageCache(path=path).get("/users/2"))
+
+    def test_shared_stale_set(self):
+        """A page read before another worker's invalidation isn't stored."""
+
+        path = os.path.join(tempfile.mkdtemp(), "pages.db")
+        worker1 = PageCache(path=path)
+        worker2 = PageCache(path=path)
+
+        started = time.time()
+        worker2.invalidate("user:1")
+        worker1.set("/users/1", page(b"old profile"), ["user:1"], since=started)
+        self.assertIsNone(worker2.get("/users/1"))
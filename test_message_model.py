@@ -2,28 +2,23 @@
 
 # Using the following to run my tests: FLASK_ENV=production python -m unittest test_message_model.py
 
-import os
-from unittest import TestCase
+from testing import TransactionalTestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Follows
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+from sqlalchemy import inspect
+from models import (db, upgrade_db, User, Message, Follows, Likes,
+                    MessageLikeShard, TimelineEntry)
 
 from app import app
 
-db.create_all()
-
-class MessageModelTestCase(TestCase):
+class MessageModelTestCase(TransactionalTestCase):
     """Test views for messages."""
 
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-        
+        super().setUp()
+
         u1 = User.signup("test1", "email1@email.com", "password", None)
         uid1 = 1111
         u1.id = uid1
@@ -46,11 +41,6 @@ class MessageModelTestCase(TestCase):
         self.client = app.test_client()
         
 
-    def tearDown(self):
-        res = super().tearDown()
-        db.session.rollback()
-        return res
-
         
     def test_message_model(self):
         """Does basic model work?"""
@@ -72,11 +62,224 @@ class MessageModelTestCase(TestCase):
         self.u1.messages.append(msg)
         db.session.commit()
         
-        self.u2.likes.append(msg)
-        
+        db.session.add(Likes(user_id=self.uid2, message_id=msg.id))
+        db.session.commit()
+
         self.assertEqual("My first post", self.u2.likes[0].text)
         self.assertEqual(self.uid1, self.u2.likes[0].user_id)
         self.assertEqual(len(self.u2.likes), 1)
-     
-        
-        
\ No newline at end of file
+
+
+    def explain(self, query):
+        """Postgres plan for `query`, with sequential and bitmap scans priced
+        out so a table this small still shows whether an index can serve it
+        (a Sort node would mean the index order doesn't match)"""
+
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        connection = db.session.connection()
+
+        # Statistics of a near-empty table make every index look as cheap
+        # as any other, so plans flip whenever autovacuum analyzes one. Give
+        # the planner another user's warbles to weigh (rolled back with the
+        # test).
+        connection.execute(
+            "INSERT INTO messages (id, text, timestamp, user_id) "
+            "SELECT g, 'filler', now(), %(uid)s FROM generate_series(1, 2000) g",
+            uid=self.uid2)
+        connection.execute(
+            "INSERT INTO timeline_entries (user_id, message_id) "
+            "SELECT %(uid)s, id FROM messages WHERE user_id = %(uid)s",
+            uid=self.uid2)
+        connection.execute("ANALYZE messages, timeline_entries")
+
+        connection.execute("SET LOCAL enable_seqscan = off")
+        connection.execute("SET LOCAL enable_bitmapscan = off")
+        rows = connection.execute(f"EXPLAIN {compiled}", compiled.params)
+        return "\n".join(row[0] for row in rows)
+
+    def test_profile_query_uses_index(self):
+        """A user's messages come off an index already in time order"""
+
+        plan = self.explain(Message.query
+                            .filter(Message.user_id == self.uid1)
+                            .order_by(Message.id.desc())
+                            .limit(101))
+
+        self.assertIn("Scan Backward using ix_messages_user_id", plan)
+        self.assertNotIn("Sort", plan)
+
+    def test_home_timeline_query_uses_index(self):
+        """A home timeline comes off its primary key already in time order"""
+
+        plan = self.explain(Message.query
+                            .join(TimelineEntry)
+                            .filter(TimelineEntry.user_id == self.uid1)
+                            .order_by(TimelineEntry.message_id.desc())
+                            .limit(101))
+
+        self.assertIn("Scan Backward using timeline_entries_pkey", plan)
+        self.assertNotIn("Sort", plan)
+
+    def test_upgrade_db(self):
+        """upgrade_db restores missing columns and indexes"""
+
+        db.session.execute("DROP INDEX ix_messages_user_id")
+        db.session.execute("ALTER TABLE users DROP COLUMN likes_count")
+        db.session.commit()
+
+        upgrade_db(db.session.connection())
+
+        inspector = inspect(db.session.connection())
+        self.assertIn("ix_messages_user_id",
+                      [i["name"] for i in inspector.get_indexes("messages")])
+        self.assertIn("likes_count",
+                      [c["name"] for c in inspector.get_columns("users")])
+
+
+    def test_message_timestamp_default(self):
+        """Each message is stamped when it is created, not when the app started"""
+
+        first = Message(text="first", user_id=self.uid1)
+        db.session.add(first)
+        db.session.commit()
+
+        second = Message(text="second", user_id=self.uid1)
+        db.session.add(second)
+        db.session.commit()
+
+        self.assertLess(first.timestamp, second.timestamp)
+
+
+    def test_message_ids_follow_creation_order(self):
+        """New messages get increasing snowflake ids"""
+
+        messages = [Message(text=f"post {i}", user_id=self.uid1) for i in range(5)]
+        for msg in messages:
+            db.session.add(msg)
+            db.session.flush()
+        db.session.commit()
+
+        ids = [msg.id for msg in messages]
+        self.assertEqual(ids, sorted(ids))
+        self.assertGreater(ids[0], 2 ** 31)
+
+
+    def test_upgrade_db_unique_constraints(self):
+        """upgrade_db swaps stale unique constraints for declared ones"""
+
+        db.session.execute("ALTER TABLE likes DROP CONSTRAINT uq_likes_user_message")
+        db.session.execute("ALTER TABLE likes ADD CONSTRAINT likes_message_id_key UNIQUE (message_id)")
+        db.session.commit()
+
+        upgrade_db(db.session.connection())
+
+        constraints = [u["name"] for u in
+                       inspect(db.session.connection()).get_unique_constraints("likes")]
+        self.assertEqual(constraints, ["uq_likes_user_message"])
+
+
+    def test_like_counts(self):
+        """like_count follows likes, sharded or not"""
+
+        u3 = User.signup("test3", "email3@email.com", "password", None)
+        msg = Message(text="popular", user_id=self.uid1)
+        db.session.add_all([u3, msg])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.uid2, message_id=msg.id))
+        db.session.commit()
+        self.assertEqual(msg.like_count, 1)
+
+        MessageLikeShard.enable(msg.id)
+        db.session.add(Likes(user_id=u3.id, message_id=msg.id))
+        db.session.commit()
+
+        self.assertTrue(msg.sharded_likes)
+        self.assertEqual(msg.like_count, 1)
+        self.assertEqual(Message.like_counts([msg]), {msg.id: 2})
+
+        MessageLikeShard.fold()
+        db.session.commit()
+
+        self.assertEqual(msg.like_count, 2)
+        self.assertEqual(Message.like_counts([msg]), {msg.id: 2})
+
+        Likes.query.filter_by(user_id=u3.id).delete()
+        Message.recount_likes()
+        db.session.commit()
+
+        self.assertEqual(Message.like_counts([msg]), {msg.id: 1})
+
+
+    def test_like_counts_after_liker_deleted(self):
+        """Deleting a user takes their likes off like counts, sharded or not"""
+
+        msg = Message(text="plain", user_id=self.uid1)
+        popular = Message(text="popular", user_id=self.uid1)
+        db.session.add_all([msg, popular])
+        db.session.commit()
+        msg_id, popular_id = msg.id, popular.id
+
+        folded = Message(text="folded", user_id=self.uid1)
+        db.session.add(folded)
+        db.session.commit()
+        folded_id = folded.id
+
+        MessageLikeShard.enable(popular_id)
+        MessageLikeShard.enable(folded_id)
+        db.session.add_all([Likes(user_id=self.uid2, message_id=msg_id),
+                            Likes(user_id=self.uid2, message_id=popular_id),
+                            Likes(user_id=self.uid2, message_id=folded_id)])
+        db.session.commit()
+
+        # Fold every like into like_count, then move popular's into shard 5,
+        # leaving shard 0 without likes of its own
+        MessageLikeShard.fold()
+        Message.query.filter_by(id=popular_id).update({Message.like_count: 0})
+        MessageLikeShard.query.filter_by(message_id=popular_id, shard=5).update(
+            {MessageLikeShard.count: 1})
+        db.session.commit()
+
+        db.session.delete(User.query.get(self.uid2))
+        db.session.commit()
+
+        messages = Message.query.filter(Message.id.in_([msg_id, popular_id, folded_id]))
+        self.assertEqual(Message.like_counts(messages.all()),
+                         {msg_id: 0, popular_id: 0, folded_id: 0})
+        self.assertEqual(
+            MessageLikeShard.query.filter(MessageLikeShard.count != 0).count(), 0)
+
+
+    def test_message_search(self):
+        """Full-text search ranks matches and pages through them"""
+
+        db.session.add_all([
+            Message(id=1, text="birds sing", user_id=self.uid1),
+            Message(id=2, text="birds, birds, birds everywhere", user_id=self.uid2),
+            Message(id=3, text="a bird in the hand", user_id=self.uid1),
+            Message(id=4, text="nothing to see here", user_id=self.uid1),
+        ])
+        db.session.commit()
+
+        results = Message.search("bird").all()
+        self.assertEqual([msg.id for msg, _ in results], [2, 3, 1])
+
+        msg, rank = results[0]
+        self.assertEqual(msg.user.username, "test2")
+        self.assertEqual([msg.id for msg, _ in Message.search("bird", (rank, msg.id))],
+                         [3, 1])
+
+        # Capped, only the newest matches are ranked
+        self.assertEqual([msg.id for msg, _ in Message.search("bird", candidates=2)],
+                         [2, 3])
+
+        # Leave only bitmap scans, so the plan shows whether the GIN index
+        # (which can't serve plain index scans) applies
+        connection = db.session.connection()
+        connection.execute("SET LOCAL enable_seqscan = off")
+        connection.execute("SET LOCAL enable_indexscan = off")
+        compiled = (Message.search("bird", candidates=1000)
+                    .statement.compile(dialect=db.engine.dialect))
+        plan = "\n".join(row[0] for row in
+                         connection.execute(f"EXPLAIN {compiled}", compiled.params))
+        self.assertIn("ix_messages_search_vector", plan)
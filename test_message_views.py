@@ -5,42 +5,36 @@
 #    FLASK_ENV=production python -m unittest test_message_views.py
 
 
-import os
-from unittest import TestCase
+from types import SimpleNamespace
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User
+from bs4 import BeautifulSoup
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+from models import db, connect_db, Message, User, Likes
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+# BEFORE we import our app, testing points it at the test database
+# (we need to do this before we import our app, since that will
+# have already connected to the database)
+
+from testing import TransactionalTestCase
 
 
 # Now we can import app
 
 from app import app, CURR_USER_KEY
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
-
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(TransactionalTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        super().setUp()
 
         u1 = User.signup("newtest1", "newemail1@email.com", "newpassword", None)
         uid1 = 1001
@@ -64,10 +58,6 @@ class MessageViewTestCase(TestCase):
         self.client = app.test_client()
         
         
-    def tearDown(self):
-        res = super().tearDown()
-        db.session.rollback()
-        return res
     
 
     def test_profile_page_with_POST(self):
@@ -85,6 +75,23 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(msg.text, "Hello")
             
     
+    def test_add_message_id_collision(self):
+        """A new message whose id another process already used gets another."""
+
+        db.session.add(Message(id=5555, text="first", user_id=self.uid2))
+        db.session.commit()
+
+        ids = iter([5555, 5556])
+        with patch('snowflake.generator', SimpleNamespace(next_id=lambda: next(ids))):
+            with self.client as client:
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.uid1
+
+                res = client.post("/messages/new", data={"text": "second"})
+
+        self.assertEqual(res.status_code, 302)
+        self.assertEqual(Message.query.filter_by(text="second").one().id, 5556)
+
     def test_profile_page(self):
         """ Making sure that the profile page renders the messages correctly. """
 
@@ -193,8 +200,155 @@ class MessageViewTestCase(TestCase):
             self.assertIn("Access unauthorized", str(resp.data))
 
             m = Message.query.get(1234)
-            self.assertIsNotNone(m) 
-            
-    
-  
-            
\ No newline at end of file
+            self.assertIsNotNone(m)
+
+
+    def test_profile_page_pagination(self):
+        """Profile pages link to older warbles one page at a time."""
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        self.addCleanup(app.config.__setitem__, 'MESSAGES_PER_PAGE', 100)
+
+        for day in (1, 2, 3):
+            msg = Message(text=f"post from day {day}",
+                          timestamp=f"{day} August 2020")
+            self.u1.messages.append(msg)
+        db.session.commit()
+
+        with self.client as client:
+            html = client.get(f"/users/{self.uid1}").get_data(as_text=True)
+
+            self.assertIn("post from day 3", html)
+            self.assertIn("post from day 2", html)
+            self.assertNotIn("post from day 1", html)
+            self.assertIn("Older warbles", html)
+
+            older = BeautifulSoup(html, 'html.parser').find(id="older-warbles")
+            html = client.get(older["href"]).get_data(as_text=True)
+
+            self.assertIn("post from day 1", html)
+            self.assertNotIn("post from day 2", html)
+            self.assertNotIn("Older warbles", html)
+
+    def test_invalid_cursor(self):
+        res = self.client.get(f"/users/{self.uid1}?before=yesterday")
+        self.assertEqual(res.status_code, 400)
+
+        res = self.client.get(f"/users/{self.uid1}?before=%C2%B2")
+        self.assertEqual(res.status_code, 400)
+
+
+    def test_like_toggle(self):
+        """Several users can like one message, and liking again unlikes it."""
+
+        u3 = User.signup("newtest3", "newemail3@email.com", "newpassword", None)
+        db.session.add(Message(id=4444, text="likeable", user_id=self.uid1))
+        db.session.commit()
+        uid3 = u3.id
+
+        with self.client as client:
+            for uid in (self.uid2, uid3):
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = uid
+                client.post("/users/add_like/4444")
+
+            likers = {like.user_id for like in Likes.query.filter_by(message_id=4444)}
+            self.assertEqual(likers, {self.uid2, uid3})
+
+            client.post("/users/add_like/4444")
+
+            likers = {like.user_id for like in Likes.query.filter_by(message_id=4444)}
+            self.assertEqual(likers, {self.uid2})
+
+
+    def test_message_show_like_count(self):
+        """A message page shows how many likes it has, sharded or not."""
+
+        app.config['LIKE_SHARD_THRESHOLD'] = 0
+        self.addCleanup(app.config.__setitem__, 'LIKE_SHARD_THRESHOLD', 1000)
+
+        db.session.add(Message(id=4444, text="likeable", user_id=self.uid1))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+            client.post("/users/add_like/4444")
+
+            html = client.get("/messages/4444").get_data(as_text=True)
+            soup = BeautifulSoup(html, 'html.parser')
+            self.assertEqual(soup.find(id="like-count").text.strip(), "1")
+            self.assertTrue(Message.query.get(4444).sharded_likes)
+
+
+    def test_message_search(self):
+        """Search results show their authors and page by rank."""
+
+        app.config['SEARCH_RESULTS_PER_PAGE'] = 1
+        self.addCleanup(app.config.__setitem__, 'SEARCH_RESULTS_PER_PAGE', 20)
+
+        db.session.add_all([
+            Message(id=1, text="warbling at dawn", user_id=self.uid1),
+            Message(id=2, text="warbling, warbling all day", user_id=self.uid2),
+        ])
+        db.session.commit()
+
+        with self.client as client:
+            html = client.get("/messages/search?q=warbling").get_data(as_text=True)
+            self.assertIn("warbling all day", html)
+            self.assertIn("@newtest2", html)
+            self.assertNotIn("at dawn", html)
+
+            more = BeautifulSoup(html, 'html.parser').find(id="more-results")
+            html = client.get(more["href"]).get_data(as_text=True)
+            self.assertIn("at dawn", html)
+            self.assertNotIn("more-results", html)
+
+            html = client.get("/messages/search?q=nightingale").get_data(as_text=True)
+            self.assertIn("Sorry, no warbles found", html)
+
+            res = client.get("/messages/search?q=warbling&after=soon")
+            self.assertEqual(res.status_code, 400)
+
+
+    def test_conditional_get(self):
+        """Unchanged profile and message pages come back as 304s."""
+
+        db.session.add(Message(id=4444, text="cacheable", user_id=self.uid1))
+        db.session.commit()
+
+        with self.client as client:
+            for url in (f"/users/{self.uid1}", "/messages/4444"):
+                res = client.get(url)
+                etag = res.headers["ETag"]
+                self.assertTrue(etag.startswith('W/"'))
+
+                res = client.get(url, headers={"If-None-Match": etag})
+                self.assertEqual(res.status_code, 304)
+                self.assertEqual(res.get_data(), b"")
+
+            self.assertIsNotNone(client.get("/messages/4444").last_modified)
+
+            # A like changes the message page; a new post the profile
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+            client.post("/users/add_like/4444")
+            with client.session_transaction() as sess:
+                del sess[CURR_USER_KEY]
+
+            res = client.get("/messages/4444", headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, 200)
+
+            etag = client.get(f"/users/{self.uid1}").headers["ETag"]
+            db.session.add(Message(text="new post", user_id=self.uid1))
+            db.session.commit()
+
+            res = client.get(f"/users/{self.uid1}", headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, 200)
+            self.assertIn("new post", res.get_data(as_text=True))
+
+            # A deploy changes every page's ETag
+            etag = client.get(f"/users/{self.uid1}").headers["ETag"]
+            with patch('app.BUILD', "next build"):
+                res = client.get(f"/users/{self.uid1}", headers={"If-None-Match": etag})
+            self.assertEqual(res.status_code, 200)
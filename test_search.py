@@ -0,0 +1,166 @@
+"""In-process search index tests."""
+
+import threading
+from unittest import TestCase
+
+from search import ReloadingIndex, UsernameIndex, MessageIndex
+
+
+class UsernameIndexTestCase(TestCase):
+    """Test username prefix lookups."""
+
+    def setUp(self):
+        self.index = UsernameIndex(
+            [(1, "alice"), (2, "Albert"), (3, "bob"), (4, "alfred"), (5, "Zoë")],
+            merge_threshold=3)
+
+    def test_suggest(self):
+        self.assertEqual(self.index.suggest("al"),
+                         [(2, "Albert"), (4, "alfred"), (1, "alice")])
+        self.assertEqual(self.index.suggest("ALI"), [(1, "alice")])
+        self.assertEqual(self.index.suggest("zo"), [(5, "Zoë")])
+        self.assertEqual(self.index.suggest("x"), [])
+        self.assertEqual(self.index.suggest(""), [])
+
+    def test_suggest_limit(self):
+        self.assertEqual(self.index.suggest("al", limit=2),
+                         [(2, "Albert"), (4, "alfred")])
+
+    def test_add_and_remove(self):
+        self.index.add(6, "alan")
+        self.assertEqual(self.index.suggest("ala"), [(6, "alan")])
+
+        self.index.remove(6, "alan")
+        self.index.remove(1, "alice")
+        self.assertEqual(self.index.suggest("al"), [(2, "Albert"), (4, "alfred")])
+        self.assertEqual(len(self.index), 4)
+
+        self.index.add(1, "alice")
+        self.assertEqual(self.index.suggest("ali"), [(1, "alice")])
+
+    def test_add_twice(self):
+        self.index.add(1, "alice")
+        self.index.add(6, "alan")
+        self.index.add(6, "alan")
+        self.assertEqual(self.index.suggest("al"),
+                         [(6, "alan"), (2, "Albert"), (4, "alfred"), (1, "alice")])
+        self.assertEqual(len(self.index), 6)
+
+    def test_rename(self):
+        self.index.rename(3, "bob", "Bobby")
+        self.assertEqual(self.index.suggest("b"), [(3, "Bobby")])
+
+        self.index.rename(3, "Bobby", "bobby")
+        self.assertEqual(self.index.suggest("b"), [(3, "bobby")])
+
+    def test_merge(self):
+        """Changes survive being folded into the compact index."""
+
+        for i, name in enumerate(["carl", "carla", "carlos"], start=10):
+            self.index.add(i, name)
+        self.index.remove(3, "bob")
+
+        self.assertEqual(self.index._overlay, [])
+        self.assertEqual(self.index.suggest("carl"),
+                         [(10, "carl"), (11, "carla"), (12, "carlos")])
+        self.assertEqual(self.index.suggest("b"), [])
+        self.assertEqual(len(self.index), 7)
+
+    def test_changes_during_merge(self):
+        """Changes made while a merge builds the new blob aren't lost."""
+
+        index = self.index
+        position = index._position
+
+        def change_midway(*args):
+            # Once, from inside the merge, with the lock free
+            if not index._lock.locked():
+                index._position = position
+                index.remove(10, "carl")
+                index.add(3, "bob")
+                index.add(13, "carmen")
+                index.remove(1, "alice")
+            return position(*args)
+
+        index.remove(3, "bob")
+        index.add(10, "carl")
+        index.add(11, "carla")
+        index._position = change_midway
+        index.add(12, "carlos")
+
+        self.assertEqual(index.suggest("car"),
+                         [(11, "carla"), (12, "carlos"), (13, "carmen")])
+        self.assertEqual(index.suggest("b"), [(3, "bob")])
+        self.assertEqual(index.suggest("ali"), [])
+        self.assertEqual(len(index), 7)
+
+
+class MessageIndexTestCase(TestCase):
+    """Test the in-process message search fallback."""
+
+    def setUp(self):
+        self.index = MessageIndex([
+            (1, "Birds sing"),
+            (2, "birds, birds everywhere"),
+            (3, "sing a song of birds"),
+        ])
+
+    def test_search(self):
+        self.assertEqual(self.index.search("BIRDS"), [(2, 2), (1, 3), (1, 1)])
+        self.assertEqual(self.index.search("birds sing"), [(2, 3), (2, 1)])
+        self.assertEqual(self.index.search("cats"), [])
+        self.assertEqual(self.index.search("!!"), [])
+
+    def test_add_and_remove(self):
+        self.index.add(4, "cats sing")
+        self.assertEqual(self.index.search("sing cats"), [(2, 4)])
+
+        self.index.remove(4, "cats sing")
+        self.assertEqual(self.index.search("cats"), [])
+        self.assertNotIn("cats", self.index._postings)
+
+
+class ReloadingIndexTestCase(TestCase):
+    """Test building and rebuilding indexes."""
+
+    def setUp(self):
+        self.users = [(1, "alice")]
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return UsernameIndex(self.users)
+
+    def test_loads_once(self):
+        holder = ReloadingIndex(self.load)
+        self.assertIsNone(holder.loaded)
+
+        # Updates before the first load are left to the load
+        holder.update('add', 2, "alfred")
+
+        threads = [threading.Thread(target=holder.get) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.loads, 1)
+        self.assertEqual(holder.get().suggest("al"), [(1, "alice")])
+
+    def test_reloads_when_old(self):
+        holder = ReloadingIndex(self.load, ttl=0)
+        holder.get()
+        self.users = [(1, "alice"), (2, "alfred")]
+
+        self.assertEqual(holder.get().suggest("al"), [(2, "alfred"), (1, "alice")])
+        self.assertEqual(self.loads, 2)
+
+    def test_updates_during_load_are_replayed(self):
+        def load():
+            # Another thread changes the index while this loads
+            holder.update('remove', 1, "alice")
+            holder.update('add', 3, "alan")
+            return UsernameIndex(self.users)
+
+        holder = ReloadingIndex(load)
+        self.assertEqual(holder.get().suggest("al"), [(3, "alan")])
@@ -0,0 +1,49 @@
+"""Snowflake id tests."""
+
+from datetime import datetime
+from unittest import TestCase
+
+from snowflake import SnowflakeGenerator, make_id, timestamp_of, worker_id, MAX_WORKER
+
+
+class SnowflakeTestCase(TestCase):
+    """Test time-sortable ids."""
+
+    def test_ids_increase(self):
+        generator = SnowflakeGenerator(7)
+        ids = [generator.next_id() for _ in range(10000)]
+
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(len(set(ids)), len(ids))
+
+    def test_workers_never_collide(self):
+        a = SnowflakeGenerator(1)
+        b = SnowflakeGenerator(2)
+
+        ids_a = {a.next_id() for _ in range(1000)}
+        ids_b = {b.next_id() for _ in range(1000)}
+
+        self.assertFalse(ids_a & ids_b)
+
+    def test_timestamp_round_trip(self):
+        when = datetime(2017, 1, 21, 11, 4, 53, 522000)
+
+        self.assertEqual(timestamp_of(make_id(when, worker=5, sequence=9)), when)
+        self.assertLess(make_id(when, sequence=4095),
+                        make_id(datetime(2017, 1, 21, 11, 4, 53, 523000)))
+
+    def test_fits_in_bigint(self):
+        self.assertLess(make_id(datetime(2060, 1, 1), MAX_WORKER), 2 ** 63)
+
+    def test_invalid_worker(self):
+        with self.assertRaises(ValueError):
+            SnowflakeGenerator(MAX_WORKER + 1)
+
+    def test_worker_id(self):
+        self.assertEqual(worker_id({'WARBLER_WORKER_ID': "12"}), 12)
+        self.assertEqual(worker_id({'WARBLER_WORKER_ID': "3", 'WEB_CONCURRENCY': "4"}), 3)
+        self.assertEqual(worker_id({}), 0)
+        self.assertEqual(worker_id({'WEB_CONCURRENCY': "1"}), 0)
+
+        with self.assertRaises(RuntimeError):
+            worker_id({'WEB_CONCURRENCY': "4"})
@@ -1,27 +1,21 @@
 """User model tests."""
 
-import os
-from unittest import TestCase
+from testing import TransactionalTestCase
 from sqlalchemy.exc import IntegrityError
-from models import db, User, Message, Follows
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+from models import (db, User, Message, Follows, Likes, TimelineEntry, has_trigram_search,
+                    hash_cost)
 
 from app import app
 
-db.create_all()
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(TransactionalTestCase):
     """Test views for user."""
 
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
-        
+        super().setUp()
+
         u1 = User.signup("test1", "email1@email.com", "password", None)
         uid1 = 1111
         u1.id = uid1
@@ -44,11 +38,6 @@ class UserModelTestCase(TestCase):
         self.client = app.test_client()
         
 
-    def tearDown(self):
-        res = super().tearDown()
-        db.session.rollback()
-        return res
-
         
     def test_user_model(self):
         """Does basic model work?"""
@@ -85,7 +74,8 @@ class UserModelTestCase(TestCase):
         
     def test_is_following(self):
         """Testing to make sure is_following successfully detect when user1 is following user2"""
-        self.u1.following.append(self.u2)
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
         db.session.commit()
         
         self.assertEqual(len(self.u1.following), 1)
@@ -95,6 +85,11 @@ class UserModelTestCase(TestCase):
         
         self.assertEqual(self.u1.following[0].id, self.uid2)
         self.assertEqual(self.u2.followers[0].id, self.uid1)
+
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u1.followers_count, 0)
+        self.assertEqual(self.u2.following_count, 0)
+        self.assertEqual(self.u2.followers_count, 1)
         
         
     def test_create_user(self):
@@ -154,5 +149,174 @@ class UserModelTestCase(TestCase):
 
 
     def test_wrong_password(self):
-        self.assertFalse(User.authenticate(self.u1.username, "badpassword"))   
+        self.assertFalse(User.authenticate(self.u1.username, "badpassword"))
+
+
+    def test_authenticate_rehashes(self):
+        """Logging in moves a password hash to the configured cost."""
+
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+        self.assertEqual(hash_cost(self.u1.password), rounds)
+
+        app.config['BCRYPT_LOG_ROUNDS'] = rounds + 1
+        self.addCleanup(app.config.__setitem__, 'BCRYPT_LOG_ROUNDS', rounds)
+
+        u = User.authenticate(self.u1.username, "password")
+        db.session.commit()
+
+        self.assertEqual(hash_cost(u.password), rounds + 1)
+        self.assertTrue(User.authenticate(self.u1.username, "password"))
+        self.assertFalse(User.authenticate(self.u1.username, "badpassword"))
+
+    def test_rebuild_timelines(self):
+        """Rebuilding timelines recovers messages written without the ORM"""
+
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
+        db.session.commit()
+
+        db.session.execute(Message.__table__.insert().values(
+            id=4321, text="bulk loaded", user_id=self.uid2))
+        db.session.commit()
+
+        timeline = TimelineEntry.query.filter_by(user_id=self.uid1)
+        self.assertEqual(timeline.count(), 0)
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        self.assertEqual([e.message_id for e in timeline], [4321])
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.uid2).count(), 1)
+
+    def test_follow_updates_timeline_and_counts(self):
+        """Adding a Follows row fills the timeline and bumps the counters"""
+
+        db.session.add(Message(id=4321, text="earlier", user_id=self.uid2))
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
+        db.session.commit()
+
+        timeline = TimelineEntry.query.filter_by(user_id=self.uid1)
+        self.assertEqual([e.message_id for e in timeline], [4321])
+        self.assertEqual(User.query.get(self.uid1).following_count, 1)
+        self.assertEqual(User.query.get(self.uid2).followers_count, 1)
+
+    def test_timelines_with_self_follow(self):
+        """A self-follow row left in the data doesn't break timelines"""
+
+        db.session.add(Follows(user_being_followed_id=self.uid1,
+                               user_following_id=self.uid1))
+        db.session.add(Message(id=4321, text="mine", user_id=self.uid1))
+        db.session.commit()
+
+        TimelineEntry.rebuild()
+        db.session.commit()
+
+        timeline = TimelineEntry.query.filter_by(user_id=self.uid1)
+        self.assertEqual([e.message_id for e in timeline], [4321])
+
+        db.session.delete(Follows.query.get((self.uid1, self.uid1)))
+        db.session.commit()
+        self.assertEqual(timeline.count(), 1)
+
+
+    def test_recount(self):
+        """Recounting repairs counts for rows written without the ORM"""
+
+        db.session.execute(Message.__table__.insert().values(
+            id=4321, text="bulk loaded", user_id=self.uid2))
+        db.session.execute(Follows.__table__.insert().values(
+            user_being_followed_id=self.uid2, user_following_id=self.uid1))
+        db.session.execute(Likes.__table__.insert().values(
+            user_id=self.uid1, message_id=4321))
+        db.session.commit()
+
+        self.assertEqual(self.u2.messages_count, 0)
+
+        User.recount()
+        db.session.commit()
+
+        self.assertEqual(self.u1.messages_count, 0)
+        self.assertEqual(self.u1.following_count, 1)
+        self.assertEqual(self.u1.likes_count, 1)
+        self.assertEqual(self.u2.messages_count, 1)
+        self.assertEqual(self.u2.followers_count, 1)
+
+
+    def test_is_following_lookup(self):
+        """is_following / is_followed_by reflect the follows table"""
+
+        self.assertFalse(self.u1.is_following(self.u2))
+        self.assertFalse(self.u2.is_followed_by(self.u1))
+
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
+        db.session.commit()
+
+        self.assertTrue(self.u1.is_following(self.u2))
+        self.assertTrue(self.u2.is_followed_by(self.u1))
+        self.assertFalse(self.u2.is_following(self.u1))
+        self.assertFalse(self.u1.is_followed_by(self.u2))
+
+
+    def test_following_ids_among(self):
+        """following_ids_among picks out followed users from a batch of ids"""
+
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
+        db.session.commit()
+
+        self.assertEqual(
+            self.u1.following_ids_among([self.uid1, self.uid2, 9999]),
+            {self.uid2})
+        self.assertEqual(self.u2.following_ids_among([self.uid1]), set())
+        self.assertEqual(self.u1.following_ids_among([]), set())
+
+
+    def test_liked_ids_among(self):
+        """liked_ids_among picks out liked messages from a batch of ids"""
+
+        db.session.add_all([
+            Message(id=1, text="liked", user_id=self.uid2),
+            Message(id=2, text="not liked", user_id=self.uid2),
+            Message(id=3, text="liked, off this page", user_id=self.uid2),
+        ])
+        db.session.commit()
+        db.session.add_all([
+            Likes(user_id=self.uid1, message_id=1),
+            Likes(user_id=self.uid1, message_id=3),
+        ])
+        db.session.commit()
+
+        self.assertEqual(self.u1.liked_ids_among([1, 2]), {1})
+        self.assertEqual(self.u2.liked_ids_among([1, 2, 3]), set())
+        self.assertEqual(self.u1.liked_ids_among([]), set())
+
+
+    def test_search(self):
+        """search matches substrings, best match first"""
+
+        User.signup("xtest1x", "email3@email.com", "password", None)
+        db.session.commit()
+
+        self.assertEqual([u.username for u in User.search("test")],
+                         ["test1", "test2", "xtest1x"])
+        self.assertEqual([u.username for u in User.search("1")],
+                         ["test1", "xtest1x"])
+
+    def test_search_uses_trigram_index(self):
+        """With pg_trgm installed, search is served by the trigram index"""
+
+        if not has_trigram_search(db.engine):
+            self.skipTest("pg_trgm is not available on this server")
+
+        connection = db.session.connection()
+        connection.execute("SET LOCAL enable_seqscan = off")
+        query = User.search("test").statement.compile(dialect=db.engine.dialect)
+        plan = "\n".join(row[0] for row in
+                         connection.execute(f"EXPLAIN {query}", query.params))
 
+        self.assertIn("ix_users_username_trgm", plan)
@@ -5,44 +5,37 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
-import os
+from datetime import datetime
 from bs4 import BeautifulSoup
 import urllib as request
-from unittest import TestCase
+from sqlalchemy import event
 
-from models import db, connect_db, Message, User, Likes, Follows
+from models import db, connect_db, known_versions, Message, User, Likes, Follows, TimelineEntry
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# BEFORE we import our app, testing points it at the test database
+# (we need to do this before we import our app, since that will
+# have already connected to the database)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+from testing import TransactionalTestCase
 
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
+from app import (app, CURR_USER_KEY, CURR_USER_SNAPSHOT_KEY, reset_username_index,
+                 page_cache, fragment_cache)
 
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(TransactionalTestCase):
     """Test views for messages."""
 
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
+        super().setUp()
 
         u1 = User.signup("newtest1", "newemail1@email.com", "newpassword", None)
         uid1 = 1001
@@ -82,10 +75,6 @@ class MessageViewTestCase(TestCase):
         self.client = app.test_client()
         
         
-    def tearDown(self):
-        res = super().tearDown()
-        db.session.rollback()
-        return res
     
 
     def test_profile_page_no_following(self):
@@ -154,7 +143,8 @@ class MessageViewTestCase(TestCase):
     def test_is_following_users(self):
         """Testing to make sure the users appear of those their following"""
         
-        self.u1.following.append(self.u2)
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
         db.session.commit()
         
         with self.client as client:
@@ -172,7 +162,8 @@ class MessageViewTestCase(TestCase):
     def test_followers(self):
         """Testing to make sure the users appear for those who are following user"""
         
-        self.u1.followers.append(self.u2)
+        db.session.add(Follows(user_being_followed_id=self.uid1,
+                               user_following_id=self.uid2))
         db.session.commit()
         
         with self.client as client:
@@ -239,5 +230,551 @@ class MessageViewTestCase(TestCase):
             # Test for a count of 1 like
             self.assertIn("1", found[3].text)
 
-         
-    
\ No newline at end of file
+
+    def test_follow_backfills_home_timeline(self):
+        """Following a user adds their warbles to my home page; unfollowing removes them."""
+
+        m = Message(id=5555, text="before the follow", user_id=self.uid2)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            html = client.get("/").get_data(as_text=True)
+            self.assertNotIn("before the follow", html)
+
+            client.post(f"/users/follow/{self.uid2}")
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn("before the follow", html)
+
+            client.post(f"/users/stop-following/{self.uid2}")
+            html = client.get("/").get_data(as_text=True)
+            self.assertNotIn("before the follow", html)
+
+    def test_follow_self(self):
+        """Users can't follow themselves."""
+
+        m = Message(id=5555, text="my own warble", user_id=self.uid1)
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            resp = client.post(f"/users/follow/{self.uid1}", follow_redirects=True)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("You can&#39;t follow yourself.", resp.get_data(as_text=True))
+            self.assertIsNone(Follows.query.get((self.uid1, self.uid1)))
+
+            html = client.get("/").get_data(as_text=True)
+            self.assertEqual(html.count("my own warble"), 1)
+
+    def test_new_message_fans_out_to_followers(self):
+        """A new warble shows up on the home page of everyone following its author."""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            client.post(f"/users/follow/{self.uid2}")
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+
+            client.post("/messages/new", data={"text": "hot off the press"})
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn("hot off the press", html)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid3
+
+            html = client.get("/").get_data(as_text=True)
+            self.assertNotIn("hot off the press", html)
+
+
+    def count_queries(self, client, url, status=200):
+        """Count the SQL statements issued while rendering `url`."""
+
+        statements = []
+
+        # Start from an empty identity map, like a fresh request would
+        db.session.remove()
+
+        def count(*args):
+            statements.append(args)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            res = client.get(url)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual(res.status_code, status)
+        res.close()
+        return len(statements)
+
+    def test_home_page_constant_queries(self):
+        """The home page costs the same number of queries regardless of how many authors it shows."""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            client.post(f"/users/follow/{self.uid2}")
+            db.session.add(Message(text="one author", user_id=self.uid2))
+            db.session.commit()
+            one_author = self.count_queries(client, "/")
+
+            client.post(f"/users/follow/{self.uid3}")
+            client.post(f"/users/follow/{self.uid4}")
+            db.session.add_all([
+                Message(text="second author", user_id=self.uid3),
+                Message(text="third author", user_id=self.uid4),
+                Message(text="fourth author", user_id=self.uid1),
+            ])
+            db.session.commit()
+            four_authors = self.count_queries(client, "/")
+
+            self.assertEqual(one_author, four_authors)
+
+
+    def test_counters_follow_routes(self):
+        """Posting, liking and following through the app keeps counts current."""
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            client.post(f"/users/follow/{self.uid2}")
+            client.post("/messages/new", data={"text": "counted"})
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+
+            msg = Message.query.filter_by(text="counted").one()
+            client.post(f"/users/add_like/{msg.id}")
+
+            u1 = User.query.get(self.uid1)
+            u2 = User.query.get(self.uid2)
+            self.assertEqual(u1.messages_count, 1)
+            self.assertEqual(u1.following_count, 1)
+            self.assertEqual(u2.followers_count, 1)
+            self.assertEqual(u2.likes_count, 1)
+
+            client.post(f"/users/add_like/{msg.id}")
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            client.post(f"/users/add_like/{msg.id}")
+            client.post(f"/users/stop-following/{self.uid2}")
+            client.post(f"/messages/{msg.id}/delete")
+
+            u1 = User.query.get(self.uid1)
+            u2 = User.query.get(self.uid2)
+            self.assertEqual(u1.messages_count, 0)
+            self.assertEqual(u1.following_count, 0)
+            self.assertEqual(u2.followers_count, 0)
+            self.assertEqual(u2.likes_count, 0)
+
+
+    def test_users_page_follow_buttons(self):
+        """User cards offer Unfollow only for users I already follow."""
+
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            html = client.get("/users").get_data(as_text=True)
+            soup = BeautifulSoup(html, 'html.parser')
+
+            unfollow = soup.find_all("form", action=lambda a: a and "stop-following" in a)
+            self.assertEqual([f["action"] for f in unfollow],
+                             [f"/users/stop-following/{self.uid2}"])
+
+
+    def test_live_home_timeline_matches_materialized(self):
+        """Reading the home page live from follows gives the materialized timeline's result."""
+
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
+        db.session.add_all([
+            Message(text="followed author", user_id=self.uid2),
+            Message(text="my own warble", user_id=self.uid1),
+            Message(text="stranger danger", user_id=self.uid3),
+        ])
+        db.session.commit()
+
+        self.addCleanup(app.config.__setitem__, 'MATERIALIZED_TIMELINES', True)
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            app.config['MATERIALIZED_TIMELINES'] = False
+            html = client.get("/").get_data(as_text=True)
+
+            self.assertIn("followed author", html)
+            self.assertIn("my own warble", html)
+            self.assertNotIn("stranger danger", html)
+
+            TimelineEntry.rebuild()
+            db.session.commit()
+
+            app.config['MATERIALIZED_TIMELINES'] = True
+            self.assertEqual(client.get("/").get_data(as_text=True), html)
+
+
+    def test_home_page_like_buttons(self):
+        """Like buttons are highlighted only for warbles I liked."""
+
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
+        db.session.add_all([
+            Message(id=6001, text="liked one", user_id=self.uid2),
+            Message(id=6002, text="unliked one", user_id=self.uid2),
+        ])
+        db.session.commit()
+        db.session.add(Likes(user_id=self.uid1, message_id=6001))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            soup = BeautifulSoup(client.get("/").get_data(as_text=True), 'html.parser')
+
+            liked = soup.find("form", action="/users/add_like/6001").button
+            unliked = soup.find("form", action="/users/add_like/6002").button
+            self.assertIn("btn-primary", liked["class"])
+            self.assertIn("btn-secondary", unliked["class"])
+
+
+    def test_likes_page_pagination(self):
+        """The likes page lists my most recent likes first, a page at a time."""
+
+        app.config['MESSAGES_PER_PAGE'] = 2
+        self.addCleanup(app.config.__setitem__, 'MESSAGES_PER_PAGE', 100)
+
+        db.session.add_all([
+            Message(id=7001, text="liked first", user_id=self.uid2),
+            Message(id=7002, text="liked second", user_id=self.uid2),
+            Message(id=7003, text="liked third", user_id=self.uid2),
+        ])
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            for message_id in (7003, 7001, 7002):
+                client.post(f"/users/add_like/{message_id}")
+
+            # Pages follow like time, not like id: make the last like the
+            # oldest, with the other two tied on time
+            likes = {like.message_id: like for like in Likes.query.filter_by(user_id=self.uid1)}
+            likes[7001].timestamp = likes[7002].timestamp = datetime(2020, 6, 1)
+            likes[7003].timestamp = datetime(2020, 5, 1)
+            db.session.commit()
+
+            html = client.get("/users/likes").get_data(as_text=True)
+            self.assertLess(html.index("liked second"), html.index("liked first"))
+            self.assertIn("Liked 01 June 2020", html)
+            self.assertNotIn("liked third", html)
+
+            older = BeautifulSoup(html, 'html.parser').find(id="older-warbles")
+            html = client.get(older["href"]).get_data(as_text=True)
+            self.assertIn("liked third", html)
+            self.assertIn("Liked 01 May 2020", html)
+            self.assertNotIn("liked first", html)
+            self.assertNotIn("older-warbles", html)
+
+            self.assertEqual(client.get("/users/likes?before=1-x").status_code, 400)
+
+
+    def test_users_search_ranking(self):
+        """Search results come best match first, a page at a time."""
+
+        app.config['USERS_PER_PAGE'] = 2
+        self.addCleanup(app.config.__setitem__, 'USERS_PER_PAGE', 48)
+
+        User.signup("test", "exact@email.com", "newpassword", None)
+        db.session.commit()
+
+        with self.client as client:
+            html = client.get("/users?q=test").get_data(as_text=True)
+            soup = BeautifulSoup(html, 'html.parser')
+
+            names = [p.text for p in soup.select(".card-link p")]
+            self.assertEqual(names, ["@test", "@newtest1"])
+
+            html = client.get(soup.find(id="more-users")["href"]).get_data(as_text=True)
+            self.assertIn("@newtest2", html)
+            self.assertIn("@newtest3", html)
+            self.assertNotIn("more-users", html)
+
+            self.assertEqual(client.get("/users?q=test&page=0").status_code, 404)
+
+    def test_users_search_wildcards(self):
+        """LIKE wildcards in a search are matched literally."""
+
+        with self.client as client:
+            html = client.get("/users?q=%25").get_data(as_text=True)
+            self.assertIn("Sorry, no users found", html)
+
+    def test_suggest_users(self):
+        """Typeahead suggestions follow signups and username changes."""
+
+        reset_username_index()
+        self.addCleanup(reset_username_index)
+
+        with self.client as client:
+            resp = client.get("/api/users/suggest?prefix=NEWTEST&limit=2")
+            self.assertEqual(resp.get_json(), [
+                {"id": self.uid1, "username": "newtest1"},
+                {"id": self.uid2, "username": "newtest2"},
+            ])
+
+            client.post("/signup", data={"username": "newtest0",
+                                         "password": "newpassword",
+                                         "email": "newemail0@email.com"})
+            resp = client.get("/api/users/suggest?prefix=newtest&limit=1")
+            self.assertEqual(resp.get_json()[0]["username"], "newtest0")
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid4
+
+            client.post("/users/profile", data={"username": "renamed",
+                                                "email": "weirdemail@email.com",
+                                                "password": "newpassword"})
+            self.assertEqual(client.get("/api/users/suggest?prefix=weird").get_json(), [])
+            self.assertEqual(client.get("/api/users/suggest?prefix=ren").get_json(),
+                             [{"id": self.uid4, "username": "renamed"}])
+
+        with app.test_client() as client:
+            # Once loaded, the index answers without any SQL at all
+            self.assertEqual(self.count_queries(client, "/api/users/suggest?prefix=n"), 0)
+
+    def test_suggest_users_loaded_after_signup(self):
+        """A signup doesn't show up twice when the index loads after it."""
+
+        reset_username_index()
+        self.addCleanup(reset_username_index)
+
+        with self.client as client:
+            client.post("/signup", data={"username": "newtest0",
+                                         "password": "newpassword",
+                                         "email": "newemail0@email.com"})
+            resp = client.get("/api/users/suggest?prefix=newtest0")
+            self.assertEqual([s["username"] for s in resp.get_json()], ["newtest0"])
+
+    def test_user_loaded_lazily(self):
+        """Requests that never look at the logged in user don't load it."""
+
+        with self.client as client:
+            self.assertEqual(self.count_queries(client, "/static/stylesheets/style.css"), 0)
+            self.assertEqual(self.count_queries(client, "/"), 0)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            self.assertEqual(self.count_queries(client, "/logout", status=302), 0)
+
+    def test_session_user_snapshot(self):
+        """With snapshots on, pages get the logged in user from the session."""
+
+        self.addCleanup(app.config.__setitem__, 'SESSION_USER_SNAPSHOT', False)
+
+        with self.client as client:
+            client.post("/login", data={"username": "newtest1",
+                                        "password": "newpassword"})
+            without_snapshot = self.count_queries(client, "/")
+
+            app.config['SESSION_USER_SNAPSHOT'] = True
+            client.post("/login", data={"username": "newtest1",
+                                        "password": "newpassword"})
+            self.assertEqual(self.count_queries(client, "/"), without_snapshot - 1)
+
+            # The user's own changes refresh the snapshot
+            client.post(f"/users/follow/{self.uid2}")
+            client.post("/users/profile", data={"username": "renamed1",
+                                                "email": "newemail1@email.com",
+                                                "password": "newpassword"})
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn("@renamed1", html)
+            with client.session_transaction() as sess:
+                snapshot = sess[CURR_USER_SNAPSHOT_KEY]
+            self.assertEqual(snapshot["following_count"], 1)
+            self.assertEqual(snapshot["version"], User.query.get(self.uid1).version)
+
+            client.get("/logout")
+            with client.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_SNAPSHOT_KEY, sess)
+
+    def test_user_deleted_in_another_session(self):
+        """A session whose user was deleted elsewhere is logged out."""
+
+        app.config['SESSION_USER_SNAPSHOT'] = True
+        self.addCleanup(app.config.__setitem__, 'SESSION_USER_SNAPSHOT', False)
+
+        with self.client as client:
+            client.post("/login", data={"username": "newtest1",
+                                        "password": "newpassword"})
+
+            db.session.delete(User.query.get(self.uid1))
+            db.session.commit()
+
+            # This worker saw the delete, so the snapshot isn't trusted
+            html = client.get("/").get_data(as_text=True)
+            self.assertNotIn("@newtest1", html)
+            with client.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+            # Another worker's delete: the first write notices
+            client.post("/login", data={"username": "newtest2",
+                                        "password": "newpassword"})
+            db.session.delete(User.query.get(self.uid2))
+            db.session.commit()
+            known_versions.clear()
+
+            resp = client.post("/messages/new", data={"text": "ghost"})
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(Message.query.filter_by(text="ghost").count(), 0)
+            with client.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+                self.assertNotIn(CURR_USER_SNAPSHOT_KEY, sess)
+
+    def test_cache_headers(self):
+        """Fingerprinted static files are cached for good, pages are not."""
+
+        with self.client as client:
+            res = client.get("/signup")
+            self.assertEqual(res.headers["Cache-Control"], "private, no-cache")
+
+            soup = BeautifulSoup(res.get_data(as_text=True), 'html.parser')
+            href = soup.find("link", href=lambda h: "style.css" in h)["href"]
+            self.assertRegex(href, r"^/static/stylesheets/style\.css\?v=\w+$")
+
+            res = client.get(href)
+            self.assertIn("immutable", res.headers["Cache-Control"])
+            self.assertIn("max-age=31536000", res.headers["Cache-Control"])
+            res.close()
+
+            res = client.get("/static/stylesheets/style.css")
+            self.assertIn("no-cache", res.headers["Cache-Control"])
+            res.close()
+
+            # Revalidating a fingerprinted file keeps it immutable
+            res = client.get(href, headers={"If-None-Match": res.headers["ETag"]})
+            self.assertEqual(res.status_code, 304)
+            self.assertIn("immutable", res.headers["Cache-Control"])
+
+            # A wrong fingerprint must not pin today's file under that URL
+            res = client.get("/static/stylesheets/style.css?v=stale")
+            self.assertNotIn("immutable", res.headers["Cache-Control"])
+            self.assertIn("no-cache", res.headers["Cache-Control"])
+            res.close()
+
+    def test_anonymous_page_cache(self):
+        """Logged out visitors get cached pages until what they show changes."""
+
+        app.config['PAGE_CACHE'] = True
+        self.addCleanup(app.config.__setitem__, 'PAGE_CACHE', False)
+        page_cache.clear()
+        self.addCleanup(page_cache.clear)
+
+        with app.test_client() as anon, app.test_client() as client:
+            url = f"/users/{self.uid1}"
+            self.assertGreater(self.count_queries(anon, url), 0)
+            self.assertEqual(self.count_queries(anon, url), 0)
+
+            etag = anon.get(url).headers["ETag"]
+            self.assertEqual(anon.get(url, headers={"If-None-Match": etag}).status_code, 304)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            # Logged in users always get a fresh page
+            self.assertGreater(self.count_queries(client, url), 0)
+
+            client.post("/messages/new", data={"text": "fresh warble"})
+            self.assertIn("fresh warble", anon.get(url).get_data(as_text=True))
+
+            # Query parameters the page doesn't read share its entry
+            self.assertEqual(self.count_queries(anon, f"{url}?utm=1"), 0)
+            self.assertEqual(self.count_queries(anon, f"{url}?utm=2"), 0)
+
+    def test_anonymous_page_cache_after_delete(self):
+        """Deleting a user refreshes the cached pages of those they followed."""
+
+        app.config['PAGE_CACHE'] = True
+        self.addCleanup(app.config.__setitem__, 'PAGE_CACHE', False)
+
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
+        db.session.commit()
+
+        with app.test_client() as anon, app.test_client() as client:
+            url = f"/users/{self.uid2}"
+            anon.get(url)
+            self.assertEqual(self.count_queries(anon, url), 0)
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+            client.post("/users/delete")
+
+            self.assertGreater(self.count_queries(anon, url), 0)
+
+    def test_message_card_fragments(self):
+        """Message cards are rendered once per message and author profile_version."""
+
+        db.session.add(Follows(user_being_followed_id=self.uid2,
+                               user_following_id=self.uid1))
+        db.session.add(Message(id=7777, text="<b>cached</b> warble", user_id=self.uid2))
+        db.session.commit()
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn("&lt;b&gt;cached&lt;/b&gt; warble", html)
+            self.assertIn("@newtest2", html)
+
+            version = User.query.get(self.uid2).profile_version
+            self.assertIsNotNone(fragment_cache.get((7777, version)))
+
+            # New followers bump the author's version, not the card's key
+            db.session.add(Follows(user_being_followed_id=self.uid2,
+                                   user_following_id=self.uid3))
+            db.session.commit()
+            self.assertEqual(User.query.get(self.uid2).profile_version, version)
+
+            # The search and profile pages render the same cached card
+            card = fragment_cache.get((7777, version))
+            self.assertIn(card, client.get(f"/users/{self.uid2}").get_data(as_text=True))
+            self.assertIn(card, client.get("/messages/search?q=cached").get_data(as_text=True))
+
+            # Renaming bumps the author's profile_version, so the card is redone
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid2
+            client.post("/users/profile", data={"username": "renamed2",
+                                                "email": "newemail2@email.com",
+                                                "password": "newpassword"})
+
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.uid1
+            html = client.get("/").get_data(as_text=True)
+            self.assertIn("@renamed2", html)
+            self.assertNotIn("@newtest2", html)
@@ -0,0 +1,86 @@
+"""Shared setup for Warbler's tests.
+
+Import this before app: it points the app at the test database (DATABASE_URL,
+default postgresql:///warbler_test) and turns bcrypt down to its cheapest
+cost (BCRYPT_LOG_ROUNDS=4), since tests hash a password for every user they
+sign up.
+
+Run the whole suite, a test module per process, with:
+
+    python runtests.py
+"""
+
+import os
+
+os.environ.setdefault('DATABASE_URL', "postgresql:///warbler_test")
+os.environ.setdefault('BCRYPT_LOG_ROUNDS', "4")
+
+from unittest import TestCase  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+from sqlalchemy.orm import scoped_session  # noqa: E402
+
+from app import app, fragment_cache, page_cache  # noqa: E402
+from models import db, known_versions  # noqa: E402
+
+db.create_all()
+
+# Tests change the database behind the app's back; each test that wants the
+# page cache turns it on itself
+app.config['PAGE_CACHE'] = False
+
+
+class TestSession(scoped_session):
+    """A scoped session that outlives requests.
+
+    Flask-SQLAlchemy removes the session when each request ends; here that
+    only empties the identity map, so the session stays on the test's
+    connection and inside its transaction.
+    """
+
+    def remove(self):
+        self.expunge_all()
+
+
+class TransactionalTestCase(TestCase):
+    """Runs each test inside a transaction that is rolled back afterwards.
+
+    db.session is swapped for one bound to a single connection with a
+    transaction open on it. Commits in the code under test release a
+    SAVEPOINT and start the next, and rollbacks roll back to it, so nothing
+    a test writes is ever really committed and there is nothing to delete.
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        # Ids get reused once a test's rows are rolled back, so start with
+        # nothing cached from earlier tests
+        fragment_cache.clear()
+        page_cache.clear()
+        known_versions.clear()
+
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+
+        self.app_session = db.session
+        db.session = TestSession(
+            db.create_session({'bind': self.connection, 'binds': {}}))
+        event.listen(db.session, 'after_transaction_end', self.restart_savepoint)
+        db.session.begin_nested()
+
+    def tearDown(self):
+        event.remove(db.session, 'after_transaction_end', self.restart_savepoint)
+        db.session.rollback()
+        db.session.close()
+        db.session = self.app_session
+
+        self.transaction.rollback()
+        self.connection.close()
+
+        super().tearDown()
+
+    @staticmethod
+    def restart_savepoint(session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()